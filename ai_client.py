@@ -1,74 +1,418 @@
 import requests
 import os
+import json
 import random
+import functools
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import tiktoken
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 from config import OPENROUTER_API_KEY, OPENROUTER_API_KEY_2, MODEL, SUM_MODEL, RATE_MODEL
+from llm_cache import llm_cache
 
 API_URL = "https://openrouter.ai/api/v1/chat/completions"
 
-def count_tokens(text, model="gpt-3.5-turbo"):
+# Общая сессия с пулом keep-alive соединений: TLS-рукопожатие не платится на каждый вызов
+POOL_SIZE = 16
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 15
+
+# Повторы на 429/5xx и обрыв соединения: экспоненциальная задержка со случайным
+# разбросом (full jitter), Retry-After от сервера имеет приоритет
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+RETRY_AFTER_MAX = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Сколько сообщений сжимается одним запросом в summarize_messages/compress_facts
+# и сколько фактов оценивается одним запросом в rate_facts
+SUMMARY_BATCH_SIZE = 8
+RATE_BATCH_SIZE = 20
+IMPORTANCE_THRESHOLD = 6
+
+# Ошибки, которые говорят о ключе или провайдере, а не о самом запросе;
+# остальные 4xx (400, 413, 422...) повторять на другом ключе бессмысленно
+KEY_ERROR_STATUSES = {401, 402, 403, 408, 429}
+
+class OpenRouterError(Exception):
+    """Ошибка в теле ответа OpenRouter; status — код из error.code, если он есть"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+def is_key_error(error):
+    """Учитывать ли ошибку в здоровье ключа: 401/402/403/429, 5xx, сбои соединения"""
+    status = None
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+    elif isinstance(error, OpenRouterError):
+        status = error.status
+    if isinstance(status, int) and 400 <= status < 500:
+        return status in KEY_ERROR_STATUSES
+    return True
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+def _retry_delay(attempt, response=None):
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return min(max(delay, 0), RETRY_AFTER_MAX)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def post_with_retries(url, headers, payload, max_retries=MAX_RETRIES, stream=False):
+    """POST через общую сессию с повторами на 429/5xx и ошибки соединения.
+    Возвращает JSON ответа, а со stream=True — сам открытый ответ"""
+    session = get_session()
+    for attempt in range(max_retries + 1):
+        last_attempt = attempt == max_retries
+        try:
+            response = session.post(url, headers=headers, json=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), stream=stream)
+        except requests.ConnectionError:
+            if last_attempt:
+                raise
+            time.sleep(_retry_delay(attempt))
+            continue
+
+        if response.status_code in RETRY_STATUSES and not last_attempt:
+            delay = _retry_delay(attempt, response)
+            print(f"[API] HTTP {response.status_code}, повтор через {delay:.1f} с")
+            response.close()
+            time.sleep(delay)
+            continue
+
+        if not response.ok:
+            # Иначе потоковый ответ держит соединение пула до сборки мусора
+            response.close()
+            response.raise_for_status()
+        return response if stream else response.json()
+
+# Circuit breaker: после CIRCUIT_FAILURES ошибок подряд ключ выключается на
+# CIRCUIT_COOLDOWN секунд. Запрос идёт сначала на самый здоровый ключ.
+# HEDGE_AFTER (секунды, None — выключено): если ответ медленный, тот же запрос
+# параллельно уходит на следующий ключ, берётся первый успешный
+CIRCUIT_FAILURES = 3
+CIRCUIT_COOLDOWN = 60
+HEDGE_AFTER = None
+HEALTH_EWMA_ALPHA = 0.2
+
+# Ограничение частоты фоновых запросов (сжатие, оценка, выгрузка) на каждый
+# ключ (token bucket): в среднем KEY_RATE_LIMIT запросов в секунду, всплеск до
+# KEY_RATE_BURST. Ответы пользователю не ограничиваются. None — без ограничения
+KEY_RATE_LIMIT = None
+KEY_RATE_BURST = 5
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Берёт токен и возвращает 0, если он есть; иначе — сколько ждать следующего"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Блокирует, пока не появится свободный токен"""
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return
+            self.waited += delay
+            time.sleep(delay)
+
+class ApiKey:
+    def __init__(self, name, key):
+        self.name = name
+        self.key = key
+        self.latency = 1.0
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.limiter = TokenBucket(KEY_RATE_LIMIT, KEY_RATE_BURST) if KEY_RATE_LIMIT else None
+
+    def is_open(self, now):
+        return self.open_until > now
+
+    def score(self):
+        """Чем меньше, тем лучше: средняя задержка с поправкой на долю ошибок"""
+        return self.latency * (1 + 4 * self.error_rate)
+
+class KeyPool:
+    """Учёт здоровья ключей OpenRouter и выбор ключа для запроса"""
+
+    def __init__(self, keys):
+        self.keys = [ApiKey(f"key{i + 1}", key) for i, key in enumerate(keys) if key]
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="hedge")
+
+    def ordered(self):
+        """Рабочие ключи по здоровью, затем выключенные (как последний шанс) по времени включения"""
+        now = time.monotonic()
+        with self._lock:
+            closed = sorted((k for k in self.keys if not k.is_open(now)), key=ApiKey.score)
+            opened = sorted((k for k in self.keys if k.is_open(now)), key=lambda k: k.open_until)
+        return closed + opened
+
+    def record(self, api_key, latency=None, error=None):
+        alpha = HEALTH_EWMA_ALPHA
+        with self._lock:
+            api_key.requests += 1
+            if error is None:
+                api_key.latency = (1 - alpha) * api_key.latency + alpha * latency
+                api_key.error_rate = (1 - alpha) * api_key.error_rate
+                api_key.consecutive_failures = 0
+                api_key.open_until = 0.0
+                return
+            api_key.failures += 1
+            api_key.error_rate = (1 - alpha) * api_key.error_rate + alpha
+            api_key.consecutive_failures += 1
+            if api_key.consecutive_failures >= CIRCUIT_FAILURES:
+                api_key.open_until = time.monotonic() + CIRCUIT_COOLDOWN
+                print(f"[API] {api_key.name} выключен на {CIRCUIT_COOLDOWN} с: {error}")
+
+    def _acquire_any(self, candidates):
+        """Первый по порядку ключ со свободным токеном (токен уже взят).
+        Если свободных нет, ждёт ближайший токен, а не токен первого ключа"""
+        while True:
+            delays = {}
+            for api_key in candidates:
+                if api_key.limiter is None:
+                    return api_key
+                delay = api_key.limiter.try_acquire()
+                if not delay:
+                    return api_key
+                delays[api_key] = delay
+            api_key, delay = min(delays.items(), key=lambda item: item[1])
+            api_key.limiter.waited += delay
+            time.sleep(delay)
+
+    def _attempt(self, api_key, request_fn, max_retries, throttle=False):
+        if throttle and api_key.limiter is not None:
+            api_key.limiter.acquire()
+        start = time.monotonic()
+        try:
+            result = request_fn(api_key.key, max_retries)
+        except Exception as e:
+            # Ошибка самого запроса (например, слишком длинный контекст) ключ не портит
+            if is_key_error(e):
+                self.record(api_key, error=e)
+            raise
+        self.record(api_key, latency=time.monotonic() - start)
+        return result
+
+    def call(self, request_fn, hedge=True, background=False):
+        """request_fn(api_key, max_retries) пробуется по ключам, пока один не ответит.
+        Фоновые запросы (background=True) проходят через ограничитель частоты ключей"""
+        candidates = self.ordered()
+        if not candidates:
+            raise Exception("Не задано ни одного ключа OpenRouter")
+
+        throttled = background and KEY_RATE_LIMIT is not None
+        if throttled:
+            # Начинаем с ключа, у которого уже есть токен; на запасных токен берётся при попытке
+            first = self._acquire_any(candidates)
+            candidates.remove(first)
+            candidates.insert(0, first)
+
+        errors = []
+        i = 0
+        while i < len(candidates):
+            api_key = candidates[i]
+            # Пока есть запасной ключ, на 429/5xx быстрее переключиться, чем ждать
+            is_last = i == len(candidates) - 1
+            max_retries = MAX_RETRIES if is_last else 1
+            hedge_key = candidates[i + 1] if hedge and HEDGE_AFTER and not is_last else None
+
+            throttle = throttled and i > 0
+            try:
+                if hedge_key is None:
+                    return self._attempt(api_key, request_fn, max_retries, throttle)
+                return self._hedged(api_key, hedge_key, request_fn, throttle, throttled)
+            except Exception as e:
+                print(f"[Ошибка API] {api_key.name}: {e}")
+                if not is_key_error(e):
+                    raise
+                errors.append(f"{api_key.name}: {e}")
+            i += 2 if hedge_key is not None else 1
+
+        raise Exception(f"Все ключи не сработали: {' | '.join(errors)}")
+
+    def _hedged(self, primary, secondary, request_fn, throttle_primary=False, throttle_secondary=False):
+        """Вызывается из call с двумя ключами, поэтому запасной ключ должен быть
+        опробован всегда, когда основной не ответил успешно"""
+        futures = [self._executor.submit(self._attempt, primary, request_fn, 1, throttle_primary)]
+        done, _ = wait(futures, timeout=HEDGE_AFTER)
+        if done:
+            error = futures[0].exception()
+            if error is None:
+                return futures[0].result()
+            if not is_key_error(error):
+                raise error
+        # Основной медленный или уже упал (401/402, быстрый 429) — пробуем запасной
+        futures.append(self._executor.submit(self._attempt, secondary, request_fn, 1, throttle_secondary))
+
+        errors = []
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                errors.append(future.exception())
+        for error in errors:
+            if not is_key_error(error):
+                raise error
+        raise Exception(" | ".join(str(error) for error in errors))
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                k.name: {
+                    "requests": k.requests,
+                    "failures": k.failures,
+                    "latency": round(k.latency, 3),
+                    "error_rate": round(k.error_rate, 3),
+                    "open_for": max(0.0, round(k.open_until - now, 1)),
+                    "throttled": round(k.limiter.waited, 1) if k.limiter else 0.0
+                }
+                for k in self.keys
+            }
+
+key_pool = KeyPool([OPENROUTER_API_KEY, OPENROUTER_API_KEY_2])
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Токенизатор модели; ищется один раз на модель"""
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    return len(encoding.encode(text or ""))
-
-def query_openrouter(prompt=None, model=MODEL, context_messages=None, system_prompt=None, t="bot"):
-    def make_request(api_key):
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        if context_messages:
-            messages.extend(context_messages)
-        if prompt:
-            messages.append({"role": "user", "content": prompt})
-
-        prompt_tokens = count_tokens(prompt, model=model)
-        if t == "rate":
-            max_output = 2560
-        elif t == "sum":
-            max_output = (prompt_tokens + 1) // 2
-        else:
-            # random_offset = random.randint(-200, 200)
-            # max_output = int(max(1, min(abs(prompt_tokens + random_offset), 4096)))
-            max_output = 2560
-        
-        data = {
-            "model": model,
-            "messages": messages,
-            "max_tokens": max_output,
-        }
-
-        response = requests.post(API_URL, headers=headers, json=data, timeout=15)
-        response.raise_for_status()
-        return response.json()
+        return tiktoken.get_encoding("cl100k_base")
 
-    try:
-        result = make_request(OPENROUTER_API_KEY)
-    except Exception as e:
-        print(f"[Ошибка API] {e}")
-        try:
-            result = make_request(OPENROUTER_API_KEY_2)
-        except Exception as e2:
-            raise Exception(f"Оба ключа не сработали: {e} | {e2}")
-        
-    if 'error' in result:
-        error_msg = result['error'].get('message', 'Unknown API error')
-        raise Exception(f"OpenRouter error: {error_msg}")
+def count_tokens(text, model="gpt-3.5-turbo"):
+    return len(get_encoding(model).encode(text or ""))
+
+def _build_request(prompt, model, context_messages, system_prompt, t):
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    if context_messages:
+        messages.extend(context_messages)
+    if prompt:
+        messages.append({"role": "user", "content": prompt})
+
+    prompt_tokens = count_tokens(prompt, model=model)
+    if t == "rate":
+        max_output = 2560
+    elif t == "sum":
+        max_output = (prompt_tokens + 1) // 2
+    else:
+        # random_offset = random.randint(-200, 200)
+        # max_output = int(max(1, min(abs(prompt_tokens + random_offset), 4096)))
+        max_output = 2560
+
+    return {
+        "model": model,
+        "messages": messages,
+        "max_tokens": max_output,
+    }
+
+def _headers(api_key):
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+
+def query_openrouter(prompt=None, model=MODEL, context_messages=None, system_prompt=None, t="bot", background=False):
+    data = _build_request(prompt, model, context_messages, system_prompt, t)
 
-    if 'choices' not in result:
-        raise Exception(f"Ответ OpenRouter не содержит 'choices': {result}")
+    def make_request(api_key, max_retries):
+        result = post_with_retries(API_URL, _headers(api_key), data, max_retries=max_retries)
 
+        # Ошибка в теле ответа тоже считается отказом ключа
+        if 'error' in result:
+            error_msg = result['error'].get('message', 'Unknown API error')
+            raise OpenRouterError(f"OpenRouter error: {error_msg}", result['error'].get('code'))
+
+        if 'choices' not in result:
+            raise Exception(f"Ответ OpenRouter не содержит 'choices': {result}")
+
+        return result
+
+    result = key_pool.call(make_request, background=background)
     return result['choices'][0]['message']['content']
 
 
-def summarize_message(message, model=SUM_MODEL):
+def stream_openrouter(prompt=None, model=MODEL, context_messages=None, system_prompt=None, t="bot"):
+    """То же, что query_openrouter, но ответ приходит по кускам (SSE, stream: true).
+    Переключение на другой ключ возможно только до начала ответа"""
+    data = _build_request(prompt, model, context_messages, system_prompt, t)
+    data["stream"] = True
+
+    def open_stream(api_key, max_retries):
+        return post_with_retries(API_URL, _headers(api_key), data, max_retries=max_retries, stream=True)
+
+    response = key_pool.call(open_stream, hedge=False)
+    response.encoding = "utf-8"
+    with response:
+        for line in response.iter_lines(decode_unicode=True):
+            # Пустые строки разделяют события, строки с ":" — комментарии-пинги
+            if not line or line.startswith(":") or not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                break
+
+            chunk = json.loads(payload)
+            if 'error' in chunk:
+                raise OpenRouterError(
+                    f"OpenRouter error: {chunk['error'].get('message', 'Unknown API error')}",
+                    chunk['error'].get('code')
+                )
+            choices = chunk.get('choices') or [{}]
+            delta = (choices[0].get('delta') or {}).get('content')
+            if delta:
+                yield delta
+
+
+def _summarize_one(message, model=SUM_MODEL):
     prompt = f"""Ты — профессиональный компрессор текста. Сожми сообщение до 1-2 предложений, сохраняя ключевые факты и эмоциональную насыщенность.
 Без вводных фраз и пояснений. От первого лица.
 
@@ -80,16 +424,95 @@ def summarize_message(message, model=SUM_MODEL):
     result = query_openrouter(
         prompt=prompt,
         model=model,
-        t="sum"
+        t="sum",
+        background=True
     )
     return result
 
 
-def compress_to_long_term(message, date, model=SUM_MODEL):
-    is_important, _ = is_important_fact(message, date)
-    if not is_important:
-        return None
-    
+def summarize_message(message, model=SUM_MODEL):
+    return summarize_messages([message], model=model)[0]
+
+
+_NUMBERED_LINE = re.compile(r"^\s*\[(\d+)\]\s?(.*)$")
+
+def _parse_numbered(response, count):
+    """Разбирает ответ вида "[1] ...\n[2] ..." в {номер: текст}; строки без номера
+    продолжают предыдущий пункт. Номера вне 1..count и пустые пункты отбрасываются"""
+    items = {}
+    current = None
+    for line in response.splitlines():
+        match = _NUMBERED_LINE.match(line)
+        if match:
+            current = int(match.group(1))
+            items[current] = [match.group(2)]
+        elif current is not None:
+            items[current].append(line)
+    result = {}
+    for number, lines in items.items():
+        text = " ".join(" ".join(lines).split())
+        if 1 <= number <= count and text:
+            result[number] = text
+    return result
+
+def _numbered(texts):
+    return "\n\n".join(f"[{i}] {' '.join(text.split())}" for i, text in enumerate(texts, 1))
+
+def _cached_batch(task, model, keys, batch_size, run_batch, run_one):
+    """Общая схема пакетных запросов: сначала кэш, промахи — пакетами по batch_size.
+
+    keys — текст ключа кэша для каждого элемента; run_batch(indices) возвращает
+    {index: результат} для разобранных элементов, run_one(index) считает один
+    элемент отдельным запросом. Результаты (строки) кладутся в кэш.
+    """
+    results = [llm_cache.get(task, model, key) for key in keys]
+    missing = [i for i, value in enumerate(results) if value is None]
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        parsed = {}
+        if len(batch) > 1:
+            try:
+                parsed = run_batch(batch)
+            except Exception as e:
+                print(f"[{task}] Ошибка пакетного запроса: {e}")
+
+        for i in batch:
+            value = parsed.get(i)
+            if value is None:
+                value = run_one(i)
+            if value is not None:
+                llm_cache.put(task, model, keys[i], value)
+            results[i] = value
+    return results
+
+def summarize_messages(messages, model=SUM_MODEL):
+    """Сжимает несколько сообщений за один запрос (до SUMMARY_BATCH_SIZE за раз).
+    Сообщения, для которых ответ не удалось разобрать, сжимаются по одному"""
+    def run_batch(indices):
+        prompt = f"""Ты — профессиональный компрессор текста. Сожми каждое сообщение до 1-2 предложений, сохраняя ключевые факты и эмоциональную насыщенность.
+Без вводных фраз и пояснений. От первого лица.
+Ответь ровно {len(indices)} строками в формате "[номер] сжатое сообщение", по одной на каждое сообщение, в том же порядке.
+
+Сообщения:
+{_numbered([messages[i] for i in indices])}
+
+Сжатые сообщения:"""
+        parsed = _parse_numbered(query_openrouter(prompt=prompt, model=model, t="sum", background=True), len(indices))
+        return {indices[n - 1]: text for n, text in parsed.items()}
+
+    return _cached_batch(
+        "sum", model, messages, SUMMARY_BATCH_SIZE,
+        run_batch, lambda i: _summarize_one(messages[i], model=model)
+    )
+
+
+def _strip_quotes(text):
+    text = text.strip()
+    if text.startswith(('"', "'")) and text.endswith(('"', "'")):
+        text = text[1:-1]
+    return text
+
+def _compress_one(message, model=SUM_MODEL):
     prompt = f"""Ты — эксперт по сжатию информации для долгосрочной памяти. Извлеки из сообщения ТОЛЬКО ОДИН САМЫЙ ВАЖНЫЙ ФАКТ по следующим правилам:
 1. Исключи все обращения к собеседнику
 2. Удали любые реакции на слова собеседника
@@ -103,19 +526,49 @@ def compress_to_long_term(message, date, model=SUM_MODEL):
     compressed_fact = query_openrouter(
         prompt=prompt,
         model=model,
-        t="sum"
-    ).strip()
-    
-    if compressed_fact.startswith(('"', "'")) and compressed_fact.endswith(('"', "'")):
-        compressed_fact = compressed_fact[1:-1]
+        t="sum",
+        background=True
+    )
     
-    return compressed_fact
+    return _strip_quotes(compressed_fact)
+
+def compress_to_long_term(message, date, model=SUM_MODEL, rate=None):
+    """Извлекает главный факт для долговременной памяти; None, если факт неважен.
+    Уже посчитанную оценку можно передать в rate, тогда повторной оценки не будет"""
+    if rate is None:
+        is_important, _ = is_important_fact(message, date)
+    else:
+        is_important = rate >= IMPORTANCE_THRESHOLD
+    if not is_important:
+        return None
+    return compress_facts([message], model=model)[0]
 
 
-def is_important_fact(fact, date):
-    prompt = f"""You are an expert in assessing information importance. Answer ONLY with a whole number from 0 to 10. No explanation.
+def compress_facts(messages, model=SUM_MODEL):
+    """Пакетная версия compress_to_long_term для уже оценённых как важные сообщений.
+    Сообщения, для которых ответ не удалось разобрать, сжимаются по одному"""
+    def run_batch(indices):
+        prompt = f"""Ты — эксперт по сжатию информации для долгосрочной памяти. Извлеки из каждого сообщения ТОЛЬКО ОДИН САМЫЙ ВАЖНЫЙ ФАКТ по следующим правилам:
+1. Исключи все обращения к собеседнику
+2. Удали любые реакции на слова собеседника
+3. Оставь только ключевой факт
+4. Формат: краткое утверждение (1 предложение) без пояснений
+Ответь ровно {len(indices)} строками в формате "[номер] факт", по одной на каждое сообщение, в том же порядке.
+
+Сообщения:
+{_numbered([messages[i] for i in indices])}
+
+Извлеченные факты:"""
+        parsed = _parse_numbered(query_openrouter(prompt=prompt, model=model, t="sum", background=True), len(indices))
+        return {indices[n - 1]: _strip_quotes(text) for n, text in parsed.items()}
+
+    return _cached_batch(
+        "compress", model, messages, SUMMARY_BATCH_SIZE,
+        run_batch, lambda i: _compress_one(messages[i], model=model)
+    )
+
 
-# Time-Based Importance Scale
+_RATING_SCALE = """# Time-Based Importance Scale
 [ETERNALLY RELEVANT]
 10 = Lifetime goals, dreams, values
 9 = Key events with a lifelong effect
@@ -126,7 +579,27 @@ def is_important_fact(fact, date):
 6 = Contextual facts
 
 [INSIGNIFICANT]
-0-5 = Routine, one-off mentions, outdated data
+0-5 = Routine, one-off mentions, outdated data"""
+
+def _parse_score(response):
+    for token in response.split():
+        if token.isdigit():
+            val = int(token)
+            if 0 <= val <= 10:
+                return val
+    return None
+
+def _rating_result(score):
+    """(важно ли, оценка) с тем же случайным сдвигом ±1, что и раньше"""
+    offset = random.randint(-1, 1)
+    final_score = max(0, min(10, score + offset))
+    return final_score >= IMPORTANCE_THRESHOLD, final_score
+
+def _rate_one(fact, date, model=RATE_MODEL):
+    """Оценка одного факта без случайного сдвига; None, если ответ не разобран"""
+    prompt = f"""You are an expert in assessing information importance. Answer ONLY with a whole number from 0 to 10. No explanation.
+
+{_RATING_SCALE}
 
 # Assessment Criteria
 1. Initial Importance: Determine a base score based on content
@@ -142,22 +615,58 @@ Answer (only number 0-10):"""
 
     response = query_openrouter(
         prompt=prompt,
-        model=RATE_MODEL,
-        t="rate"
+        model=model,
+        t="rate",
+        background=True
     ).strip()
 
-    score = None
-    for token in response.split():
-        if token.isdigit():
-            val = int(token)
-            if 0 <= val <= 10:
-                score = val
-                break
-    
-    
-    if score is not None:
-        offset = random.randint(-1, 1)
-        final_score = max(0, min(10, score + offset))
-        return final_score >= 6, final_score
+    return _parse_score(response)
+
+def is_important_fact(fact, date):
+    """(важно ли, оценка); если оценку получить не удалось — (False, None)"""
+    return rate_facts([(fact, date)])[0]
+
+
+def rate_facts(facts, model=RATE_MODEL):
+    """Оценивает важность списка фактов [(fact, date)] пакетами по RATE_BATCH_SIZE.
+    Возвращает [(важно ли, оценка)]; если оценку не удалось получить — (False, None)"""
+    # Оценка зависит от сегодняшней даты, поэтому она входит в ключ кэша
+    today = datetime.utcnow().date().isoformat()
+    keys = [f"{today}\n{date}\n{fact}" for fact, date in facts]
+
+    def run_batch(indices):
+        numbered = "\n".join(
+            f"[{n}] (from {facts[i][1]}) \"{' '.join(facts[i][0].split())}\"" for n, i in enumerate(indices, 1)
+        )
+        prompt = f"""You are an expert in assessing information importance. Rate each fact with a whole number from 0 to 10. No explanation.
+
+{_RATING_SCALE}
+
+# Assessment Criteria
+1. Initial Importance: Determine a base score based on content
+2. Time-Based Importance:
+• For categories 6-8: Reduce by 1 point for every 5 days since the fact (its date is given in parentheses), unless there is a specific validity period.
+• Today: {datetime.utcnow().strftime("%d.%m %H:%M")}
+3. For 9-10 points, time is NOT taken into account.
+
+Facts:
+{numbered}
+
+Answer with exactly {len(indices)} lines in the format "[number] score", one per fact, in the same order:"""
+        parsed = _parse_numbered(query_openrouter(prompt=prompt, model=model, t="rate", background=True), len(indices))
+        scores = {}
+        for n, text in parsed.items():
+            score = _parse_score(text)
+            if score is not None:
+                scores[indices[n - 1]] = str(score)
+        return scores
+
+    def run_one(i):
+        score = _rate_one(*facts[i], model=model)
+        return str(score) if score is not None else None
 
-    return False
+    scores = _cached_batch("rate", model, keys, RATE_BATCH_SIZE, run_batch, run_one)
+    return [
+        _rating_result(int(score)) if score is not None else (False, None)
+        for score in scores
+    ]
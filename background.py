@@ -0,0 +1,40 @@
+import queue
+import threading
+import traceback
+
+class KeyedWorkerPool:
+    """Фоновые воркеры с ограниченными очередями.
+
+    Задачи с одним ключом всегда попадают к одному и тому же воркеру и
+    выполняются строго в порядке постановки; разные ключи идут параллельно.
+    Когда очередь воркера заполнена, submit блокируется (обратное давление).
+    """
+
+    def __init__(self, name, workers=4, queue_size=256):
+        self.name = name
+        self.failed = 0
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        for i, q in enumerate(self._queues):
+            threading.Thread(target=self._worker, args=(q,), name=f"{name}-{i}", daemon=True).start()
+
+    def submit(self, key, fn, *args, **kwargs):
+        self._queues[hash(key) % len(self._queues)].put((fn, args, kwargs))
+
+    def pending(self):
+        return sum(q.unfinished_tasks for q in self._queues)
+
+    def join(self):
+        for q in self._queues:
+            q.join()
+
+    def _worker(self, q):
+        while True:
+            fn, args, kwargs = q.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                self.failed += 1
+                print(f"[{self.name}] Ошибка фоновой задачи {getattr(fn, '__name__', fn)}: {e}")
+                traceback.print_exc()
+            finally:
+                q.task_done()
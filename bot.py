@@ -7,23 +7,96 @@ import torch
 import tempfile
 import threading
 import traceback
+import schedule
+from contextlib import contextmanager
 from config import TELEGRAM_TOKEN
-from db import init_db
-from messages import handle_message_as_bot, get_user_chats
+from db import init_db, init_vectors, index_missing_vectors, embedding_model, touch_chat
+from messages import handle_message_as_bot, offload_idle_chats
 from tests import TESTS, test_manager
 
-init_db()
+STARTED_AT = time.perf_counter()
+startup_timings = {}
+
+@contextmanager
+def startup_stage(name):
+    """Замеряет этап запуска и печатает его длительность"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - start
+        print(f"[Запуск] {name}: {startup_timings[name]:.2f} с (с начала {time.perf_counter() - STARTED_AT:.2f} с)")
+
+with startup_stage("init_db"):
+    init_db()
 
 bot = telebot.TeleBot(TELEGRAM_TOKEN)
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
-print(f"Инициализация Whisper model на {device}...")
 torch.set_num_threads(os.cpu_count())
-WHISPER_MODEL = whisper.load_model("base", device=device)
-print("Whisper model загружена")
+WHISPER_MODEL = None
+
+# Модели грузятся в фоне параллельно, polling стартует сразу:
+# текст ждёт только эмбеддер, голос — только Whisper
+text_ready = threading.Event()
+whisper_ready = threading.Event()
+
+def load_whisper():
+    global WHISPER_MODEL
+    print(f"Инициализация Whisper model на {device}...")
+    try:
+        with startup_stage("whisper"):
+            WHISPER_MODEL = whisper.load_model("base", device=device)
+        print("Whisper model загружена")
+    except Exception as e:
+        print(f"Ошибка загрузки Whisper: {e}")
+        traceback.print_exc()
+    finally:
+        whisper_ready.set()
+
+def warm_up_text():
+    try:
+        with startup_stage("embedding_model"):
+            embedding_model.load()
+        with startup_stage("vector_store"):
+            init_vectors()
+    except Exception as e:
+        print(f"Ошибка подготовки эмбеддингов: {e}")
+        traceback.print_exc()
+    finally:
+        text_ready.set()
+
+    try:
+        with startup_stage("index_missing_vectors"):
+            index_missing_vectors()
+    except Exception as e:
+        print(f"Ошибка индексации: {e}")
+        traceback.print_exc()
+
+# Как часто планировщик ищет пользователей, которых пора выгрузить
+OFFLOAD_CHECK_MINUTES = 5
+
+def run_scheduler():
+    text_ready.wait()
+    schedule.every(OFFLOAD_CHECK_MINUTES).minutes.do(offload_idle_chats)
+    while True:
+        try:
+            schedule.run_pending()
+        except Exception as e:
+            print(f"Ошибка планировщика: {e}")
+            traceback.print_exc()
+        time.sleep(1)
+
+threading.Thread(target=load_whisper, name="whisper-load", daemon=True).start()
+threading.Thread(target=warm_up_text, name="text-warmup", daemon=True).start()
+threading.Thread(target=run_scheduler, name="scheduler", daemon=True).start()
 
 def transcribe_audio(audio_path):
     """Транскрибируем аудио в текст с помощью Whisper"""
+    whisper_ready.wait()
+    if WHISPER_MODEL is None:
+        print("Ошибка: Whisper model не загружена")
+        return None
     try:
         fp16 = (device == "cuda")
         result = WHISPER_MODEL.transcribe(
@@ -50,7 +123,7 @@ def handle_voice(message):
         user_id = message.from_user.id
         chat_id = message.chat.id
             
-        get_user_chats().add(chat_id)
+        touch_chat(chat_id)
 
         file_info = bot.get_file(message.voice.file_id)
         downloaded_file = bot.download_file(file_info.file_path)
@@ -66,6 +139,7 @@ def handle_voice(message):
             bot.reply_to(message, "Не удалось распознать речь или сообщение пустое")
             return
 
+        text_ready.wait()
         handle_message_as_bot(bot, chat_id, text)
         
     except Exception as e:
@@ -241,12 +315,14 @@ def echo_handler(message):
         return
         
     text = message.text.strip()
-    get_user_chats().add(chat_id)
+    touch_chat(chat_id)
 
     bot.send_chat_action(message.chat.id, 'typing')
+    text_ready.wait()
     handle_message_as_bot(bot, chat_id, text)
 
 if __name__ == '__main__':
+    print(f"[Запуск] Бот принимает сообщения через {time.perf_counter() - STARTED_AT:.2f} с")
     while True:
         try:
             bot.infinity_polling()
@@ -0,0 +1,51 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Настройки соединений SQLite. WAL позволяет читать параллельно с записью,
+# synchronous=NORMAL в WAL не теряет целостность при сбое процесса
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_CACHE_SIZE_KB = 16384
+SQLITE_CACHED_STATEMENTS = 256
+
+_local = threading.local()
+
+def _open(path):
+    conn = sqlite3.connect(
+        path,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=SQLITE_CACHED_STATEMENTS
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    return conn
+
+def get_connection(path):
+    """Долгоживущее соединение текущего потока с базой path.
+    Соединения не делятся между потоками и закрываются вместе с потоком"""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(path)
+    if conn is None:
+        conn = connections[path] = _open(path)
+    return conn
+
+@contextmanager
+def connection(path):
+    """Соединение потока с фиксацией изменений при выходе и откатом при ошибке"""
+    conn = get_connection(path)
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+def close_connections():
+    """Закрывает соединения текущего потока"""
+    for conn in getattr(_local, "connections", {}).values():
+        conn.close()
+    _local.connections = {}
@@ -1,35 +1,41 @@
-import sqlite3
+import re
 from datetime import datetime
 import numpy as np
 from config import DB_PATH
 from vector_store import vector_store
 from embeddings import EmbeddingModel
-from contextlib import contextmanager
+from connections import connection
+from migrations import migrate, add_column
 
 embedding_model = EmbeddingModel()
 
-@contextmanager
-def db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        yield conn
-    finally:
-        conn.commit()
-        conn.close()
+# Короткий контекст и долговременная память индексируются раздельно
+CONTEXT_COLLECTION = "context"
+LONG_TERM_COLLECTION = "long_term"
+_TABLE_COLLECTIONS = {
+    "context_memory": CONTEXT_COLLECTION,
+    "long_term_memory": LONG_TERM_COLLECTION
+}
 
-def init_db():
-    """Инициализация базы SQLite (только для авторизации и метаданных)"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+REINDEX_BATCH_SIZE = 64
+# Сколько id подставляется в один запрос IN (...) при удалении
+DELETE_BATCH_SIZE = 500
+
+_TIME_PREFIX = re.compile(r"^\[\d{2}\.\d{2} \d{2}:\d{2}\]")
+
+def db_connection():
+    """Общее соединение потока с DB_PATH: фиксация при выходе, откат при ошибке"""
+    return connection(DB_PATH)
 
-    c.execute('''
+def _create_tables(conn):
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS auth (
             user_id INTEGER PRIMARY KEY,
             authorized INTEGER DEFAULT 0
         )
     ''')
-    
-    c.execute('''
+
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS long_term_memory (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -41,7 +47,7 @@ def init_db():
         )
     ''')
 
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS context_memory (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -53,23 +59,171 @@ def init_db():
         )
     ''')
 
+def _add_vector_ids(conn):
+    for table in ("long_term_memory", "context_memory"):
+        add_column(conn, table, "vector_id", "INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_long_term_vector ON long_term_memory (vector_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_context_vector ON context_memory (vector_id)")
+
+def _add_rated_at(conn):
+    # Дата последней оценки: от неё локально считается убывание важности
+    add_column(conn, "long_term_memory", "rated_at", "TEXT")
+
+def _create_chats(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            last_activity TEXT,
+            offloaded_at TEXT
+        )
+    ''')
+    # Чаты с несброшенным контекстом, появившиеся до реестра
+    conn.execute('''
+        INSERT OR IGNORE INTO chats (chat_id, last_activity)
+        SELECT user_id, MAX(timestamp_iso) FROM context_memory GROUP BY user_id
+    ''')
+
+def _add_user_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_context_user_time ON context_memory (user_id, timestamp_iso)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_long_term_user ON long_term_memory (user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_activity ON chats (last_activity)")
+
+def _create_llm_cache(conn):
+    # Кэш ответов LLM (llm_cache.py) лежит в той же базе
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            task TEXT,
+            model TEXT,
+            value TEXT,
+            created_at REAL,
+            last_used REAL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used)")
+
+# Только дописывать в конец: номер миграции — её позиция в списке
+MIGRATIONS = [
+    _create_tables,
+    _add_vector_ids,
+    _add_rated_at,
+    _create_chats,
+    _add_user_indexes,
+    _create_llm_cache
+]
+
+def init_db():
+    """Инициализация базы SQLite: миграции схемы"""
+    with db_connection() as conn:
+        migrate(conn, MIGRATIONS, "memory")
+
+def init_vectors():
+    """Сверка векторного хранилища с моделью; вызывается, когда модель эмбеддингов загружена.
+    Записи без векторов после этого индексируются отдельно (index_missing_vectors)"""
+    embedding_model.wait_ready()
+    check_embedding_model()
+
+def _reset_vectors(conn):
+    """Забывает все vector_id и удаляет коллекции; векторы построит index_missing_vectors"""
+    c = conn.cursor()
+    for table in _TABLE_COLLECTIONS:
+        c.execute(f"UPDATE {table} SET vector_id = NULL")
     conn.commit()
-    conn.close()
+    for name in vector_store.collection_names():
+        vector_store.drop(name)
+
+def check_embedding_model():
+    """Перестраивает хранилище, если векторы считались другой моделью эмбеддингов"""
+    current = {"model": embedding_model.model_name, "dim": embedding_model.dim}
+    stored = vector_store.get_model_info()
+    if stored is None and vector_store.collection_names():
+        # До записи info.json векторы всегда строились e5-large
+        stored = {"model": "intfloat/multilingual-e5-large", "dim": 1024}
+
+    if stored is not None and stored != current:
+        print(f"[VectorStore] Модель сменилась ({stored['model']} -> {current['model']}), векторы будут пересчитаны")
+        with db_connection() as conn:
+            _reset_vectors(conn)
+
+    vector_store.set_model_info(current["model"], current["dim"])
+
+def index_missing_vectors():
+    """Строит векторы для записей, у которых ещё нет vector_id (перенос старого хранилища)"""
+    with db_connection() as conn:
+        c = conn.cursor()
+        indexed = 0
+        for table, collection in _TABLE_COLLECTIONS.items():
+            store = vector_store.collection(collection)
+            c.execute(f"SELECT id, user_id, summary FROM {table} WHERE vector_id IS NULL")
+            rows = c.fetchall()
+            for start in range(0, len(rows), REINDEX_BATCH_SIZE):
+                batch = rows[start:start + REINDEX_BATCH_SIZE]
+                # В контексте summary хранится с меткой времени, а эмбеддинг строился без неё
+                texts = [_TIME_PREFIX.sub("", summary or "", count=1) for _, _, summary in batch]
+                embeddings = embedding_model.get_embeddings(texts)
+                for (row_id, user_id, _), text, embedding in zip(batch, texts, embeddings):
+                    if not text.strip():
+                        continue
+                    vector_id = store.add(user_id, embedding)
+                    c.execute(f"UPDATE {table} SET vector_id = ? WHERE id = ?", (vector_id, row_id))
+                    indexed += 1
+                conn.commit()
+
+    if indexed:
+        print(f"[VectorStore] Проиндексировано записей без вектора: {indexed}")
+
+    # Все записи теперь в коллекциях: старый единый индекс больше не нужен
+    for path in vector_store.remove_legacy_files():
+        print(f"[VectorStore] Удалён файл старого индекса: {path}")
 
 def is_authorized(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT authorized FROM auth WHERE user_id = ?", (user_id,))
-    result = c.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT authorized FROM auth WHERE user_id = ?", (user_id,))
+        result = c.fetchone()
     return result and result[0] == 1
 
 def authorize_user(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO auth (user_id, authorized) VALUES (?, 1)", (user_id,))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("INSERT OR REPLACE INTO auth (user_id, authorized) VALUES (?, 1)", (user_id,))
+
+def touch_chat(chat_id):
+    """Регистрирует чат и отмечает время последней активности"""
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO chats (chat_id, last_activity) VALUES (?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET last_activity = excluded.last_activity",
+            (chat_id, datetime.utcnow().isoformat())
+        )
+
+def get_chat_ids():
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT chat_id FROM chats")
+        rows = [row[0] for row in c.fetchall()]
+    return rows
+
+def get_idle_chats(idle_since, limit=None):
+    """Чаты без активности с idle_since (ISO), у которых после последней
+    активности ещё не было выгрузки; самые давние первыми"""
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute('''
+            SELECT chat_id FROM chats
+            WHERE last_activity < ? AND (offloaded_at IS NULL OR offloaded_at < last_activity)
+            ORDER BY last_activity
+            LIMIT ?
+        ''', (idle_since, -1 if limit is None else limit))
+        rows = [row[0] for row in c.fetchall()]
+    return rows
+
+def mark_offloaded(chat_id, offloaded_at):
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE chats SET offloaded_at = ? WHERE chat_id = ?", (offloaded_at, chat_id))
+
 def add_to_context(user_id, role, content, summary):
     """Добавление сообщения в текущий контекст + вектор в индекс"""
     now = datetime.utcnow()
@@ -77,57 +231,67 @@ def add_to_context(user_id, role, content, summary):
     readable_stamp = now.strftime("%d.%m %H:%M")
     summary_with_time = f"[{readable_stamp}]{summary}"
 
-    embedding = embedding_model.blob_to_numpy(
-        embedding_model.get_embedding(summary)
-    )
+    embedding = embedding_model.embed(summary)
 
-    vector_store.add(
-        embedding,
-        {
-            "user_id": user_id,
-            "role": role,
-            "content": content,
-            "summary": summary_with_time,
-            "timestamp": timestamp_iso
-        }
-    )
+    # Пустое сжатие не индексируется: строка сохраняется без вектора
+    vector_id = None
+    if embedding is not None:
+        vector_id = vector_store.collection(CONTEXT_COLLECTION).add(user_id, embedding)
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO context_memory (user_id, role, content, summary, timestamp, timestamp_iso) VALUES (?, ?, ?, ?, ?, ?)",
-        (user_id, role, content, summary_with_time, readable_stamp, timestamp_iso)
-    )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO context_memory (user_id, role, content, summary, timestamp, timestamp_iso, vector_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, role, content, summary_with_time, readable_stamp, timestamp_iso, vector_id)
+        )
+
+def embed_query(query):
+    """Эмбеддинг поискового запроса; считается один раз и передаётся во все поиски"""
+    return embedding_model.embed(query, is_query=True)
 
-def search_context(user_id, query, threshold=0.3, top_k=10):
+def search_context(user_id, query, threshold=0.3, top_k=10, query_vec=None):
     """Поиск релевантных сообщений в контексте по векторному индексу"""
-    if not query.strip():
+    if query_vec is None:
+        query_vec = embed_query(query)
+    if query_vec is None:
         return []
 
-    query_vec = embedding_model.blob_to_numpy(
-        embedding_model.get_embedding(query, is_query=True)
+    results = vector_store.collection(CONTEXT_COLLECTION).search(query_vec, user_id, top_k=top_k, threshold=threshold)
+    rows = _fetch_by_vector_ids(
+        "SELECT vector_id, role, summary, timestamp_iso FROM context_memory",
+        user_id, [vector_id for _, vector_id in results]
     )
-
-    results = vector_store.search(query_vec, top_k=top_k, threshold=threshold)
     return [
-        (meta["role"], meta["summary"], meta["timestamp"])
-        for _, meta in results if meta["user_id"] == user_id
+        (*rows[vector_id], score)
+        for score, vector_id in results if vector_id in rows
     ]
 
+def _fetch_by_vector_ids(select_sql, user_id, vector_ids):
+    """Достаёт из SQLite строки для найденных векторов: {vector_id: остальные колонки}"""
+    if not vector_ids:
+        return {}
+
+    placeholders = ", ".join("?" * len(vector_ids))
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            f"{select_sql} WHERE user_id = ? AND vector_id IN ({placeholders})",
+            (user_id, *vector_ids)
+        )
+        rows = c.fetchall()
+    return {row[0]: row[1:] for row in rows}
+
 def get_recent_context(user_id, limit=24):
     """Возвращает последние N сообщений из контекста (без поиска по эмбеддингам)"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        SELECT role, content, summary FROM context_memory 
-        WHERE user_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT ?
-    """, (user_id, limit))
-    rows = c.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT role, content, summary FROM context_memory 
+            WHERE user_id = ? 
+            ORDER BY timestamp_iso DESC 
+            LIMIT ?
+        """, (user_id, limit))
+        rows = c.fetchall()
 
     rows = rows[::-1]
     if not rows:
@@ -146,94 +310,145 @@ def get_recent_context(user_id, limit=24):
 
 def clear_context(user_id):
     """Удаляет весь текущий контекст пользователя и очищает векторное хранилище"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM context_memory WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM context_memory WHERE user_id = ?", (user_id,))
 
-    # Очистка FAISS по user_id
-    vector_store.delete(lambda meta: meta["user_id"] == user_id)
+    # Подындекс пользователя в коллекции контекста выбрасывается целиком
+    vector_store.collection(CONTEXT_COLLECTION).drop_partition(user_id)
 
 def get_full_context(user_id):
     """Возвращает все сообщения контекста пользователя"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        SELECT role, summary, content, timestamp 
-        FROM context_memory 
-        WHERE user_id = ?
-    """, (user_id,))
-    rows = c.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT role, summary, content, timestamp 
+            FROM context_memory 
+            WHERE user_id = ?
+        """, (user_id,))
+        rows = c.fetchall()
+    return rows
+
+def get_context_snapshot(user_id):
+    """Контекст пользователя для выгрузки: (id, role, summary, content, timestamp_iso)
+    в порядке id; по наибольшему id потом удаляется ровно выгруженное"""
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT id, role, summary, content, timestamp_iso
+            FROM context_memory
+            WHERE user_id = ?
+            ORDER BY id
+        """, (user_id,))
+        rows = c.fetchall()
     return rows
 
+def delete_context_up_to(user_id, max_id):
+    """Удаляет строки контекста с id <= max_id и их векторы. Реплики, записанные
+    после снимка (например, во время выгрузки), остаются; возвращает их число"""
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT vector_id FROM context_memory WHERE user_id = ? AND id <= ? AND vector_id IS NOT NULL",
+            (user_id, max_id)
+        )
+        vector_ids = [row[0] for row in c.fetchall()]
+        c.execute("DELETE FROM context_memory WHERE user_id = ? AND id <= ?", (user_id, max_id))
+        c.execute("SELECT COUNT(*) FROM context_memory WHERE user_id = ?", (user_id,))
+        remaining = c.fetchone()[0]
+
+    if vector_ids:
+        vector_store.collection(CONTEXT_COLLECTION).remove_ids(user_id, vector_ids)
+    return remaining
+
 def save_to_long_term(user_id, role, content, summary, rate):
     """Сохраняет сообщение в долговременную память и векторное хранилище"""
-    emb = embedding_model.blob_to_numpy(
-        embedding_model.get_embedding(summary)
-    )
+    emb = embedding_model.embed(summary)
 
-    vector_store.add(
-        emb,
-        {
-            "user_id": user_id,
-            "role": role,
-            "content": content,
-            "summary": summary,
-            "date": datetime.utcnow().date().isoformat(),
-            "rate": rate
-        }
-    )
+    vector_id = None
+    if emb is not None:
+        vector_id = vector_store.collection(LONG_TERM_COLLECTION).add(user_id, emb)
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO long_term_memory (user_id, role, content, summary, date, rate) VALUES (?, ?, ?, ?, ?, ?)",
-        (user_id, role, content, summary, datetime.utcnow().date().isoformat(), rate)
-    )
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            "INSERT INTO long_term_memory (user_id, role, content, summary, date, rate, vector_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, role, content, summary, datetime.utcnow().date().isoformat(), rate, vector_id)
+        )
 
-def delete_from_long_term(user_id, summary):
-    """Удаляет запись из долговременной памяти"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM long_term_memory WHERE user_id = ? AND summary = ?", (user_id, summary))
-    conn.commit()
-    conn.close()
+def _delete_long_term_rows(c, user_id, row_ids):
+    """Удаляет строки по id в текущей транзакции; возвращает их vector_id"""
+    vector_ids = []
+    for start in range(0, len(row_ids), DELETE_BATCH_SIZE):
+        batch = row_ids[start:start + DELETE_BATCH_SIZE]
+        placeholders = ", ".join("?" * len(batch))
+        c.execute(
+            f"SELECT vector_id FROM long_term_memory WHERE user_id = ? AND id IN ({placeholders})",
+            (user_id, *batch)
+        )
+        vector_ids.extend(row[0] for row in c.fetchall() if row[0] is not None)
+        c.execute(
+            f"DELETE FROM long_term_memory WHERE user_id = ? AND id IN ({placeholders})",
+            (user_id, *batch)
+        )
+    return vector_ids
+
+def delete_from_long_term(user_id, row_ids):
+    """Удаляет записи долговременной памяти по id одной транзакцией,
+    их векторы — одним вызовом к хранилищу"""
+    row_ids = list(row_ids)
+    if not row_ids:
+        return
+    with db_connection() as conn:
+        vector_ids = _delete_long_term_rows(conn.cursor(), user_id, row_ids)
 
-    vector_store.delete(lambda meta: meta["user_id"] == user_id and meta["summary"] == summary)
+    if vector_ids:
+        vector_store.collection(LONG_TERM_COLLECTION).remove_ids(user_id, vector_ids)
+
+def apply_long_term_prune(user_id, rate_updates, deleted_ids):
+    """Одной транзакцией обновляет оценки [(id, rate)] и удаляет записи по id;
+    векторы удалённых записей убираются одним вызовом"""
+    rated_at = datetime.utcnow().date().isoformat()
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.executemany(
+            "UPDATE long_term_memory SET rate = ?, rated_at = ? WHERE user_id = ? AND id = ?",
+            [(rate, rated_at, user_id, row_id) for row_id, rate in rate_updates]
+        )
+        vector_ids = _delete_long_term_rows(c, user_id, list(deleted_ids))
+
+    if vector_ids:
+        vector_store.collection(LONG_TERM_COLLECTION).remove_ids(user_id, vector_ids)
 
 def get_long_term_memory(user_id):
     """Возвращает список всех долговременных воспоминаний"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT role, summary, date FROM long_term_memory WHERE user_id = ?", (user_id,))
-    rows = c.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT role, summary, date FROM long_term_memory WHERE user_id = ?", (user_id,))
+        rows = c.fetchall()
     return rows
 
 def get_long_term_memory_prune(user_id):
     """Возвращает список воспоминаний для чистки"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT summary, date, rate FROM long_term_memory WHERE user_id = ?", (user_id,))
-    rows = c.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, summary, date, rate, rated_at FROM long_term_memory WHERE user_id = ?", (user_id,))
+        rows = c.fetchall()
     return rows
 
-def search_memories(user_id, query, threshold=0.3, top_k=10):
+def search_memories(user_id, query, threshold=0.3, top_k=10, query_vec=None):
     """Поиск по долговременной памяти с использованием векторного поиска"""
-    if not query.strip():
+    if query_vec is None:
+        query_vec = embed_query(query)
+    if query_vec is None:
         return []
 
-    query_vec = embedding_model.blob_to_numpy(
-        embedding_model.get_embedding(query, is_query=True)
+    results = vector_store.collection(LONG_TERM_COLLECTION).search(query_vec, user_id, top_k=top_k, threshold=threshold)
+    rows = _fetch_by_vector_ids(
+        "SELECT vector_id, role, summary FROM long_term_memory",
+        user_id, [vector_id for _, vector_id in results]
     )
-
-    results = vector_store.search(query_vec, top_k=top_k, threshold=threshold)
     return [
-        (meta["role"], meta["summary"])
-        for _, meta in results if meta["user_id"] == user_id
+        (*rows[vector_id], score)
+        for score, vector_id in results if vector_id in rows
     ]
@@ -1,38 +1,323 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import queue
 import torch
 import numpy as np
 from sentence_transformers import SentenceTransformer
 
-class EmbeddingModel:
-    _instance = None
+# Модель и бэкенд эмбеддингов. Для CPU без GPU быстрее всего "onnx"/"openvino"
+# или "torch-int8"; меньшие модели: intfloat/multilingual-e5-base (768),
+# intfloat/multilingual-e5-small (384). Размерность берётся из модели, при её
+# смене векторное хранилище перестраивается (см. db.check_embedding_model)
+EMBEDDING_MODEL = "intfloat/multilingual-e5-large"
+EMBEDDING_BACKEND = "torch"
+ONNX_FILE_NAME = None
 
-    def __init__(self):
-        if EmbeddingModel._instance is None:
-            self.device = "cuda" if torch.cuda.is_available() else "cpu"
-            print(f"[EmbeddingModel] Используется устройство: {self.device}")
-            self.model = SentenceTransformer(
-                "intfloat/multilingual-e5-large",
-                device=self.device
-            )
-            EmbeddingModel._instance = self
-        else:
-            self.model = EmbeddingModel._instance.model
-            self.device = EmbeddingModel._instance.device
+CACHE_SIZE = 4096
+ENCODE_BATCH_SIZE = 32
 
-    def get_embedding(self, text: str, is_query: bool = False) -> bytes | None:
-        if not text.strip():
-            return None
+# Микробатчинг: запросы из разных чатов, пришедшие в пределах окна,
+# кодируются одним вызовом model.encode
+USE_MICROBATCHING = True
+MICROBATCH_WAIT_MS = 5
+MICROBATCH_MAX_SIZE = 32
 
-        prefix = "query: " if is_query else "passage: "
-        text = prefix + text.strip()
+class EmbeddingCache:
+    """Ограниченный LRU-кэш эмбеддингов по ключу (нормализованный текст, is_query)"""
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._items)
+            }
+
+class EmbeddingBatcher:
+    """Собирает одиночные запросы из разных потоков в общий батч"""
+
+    def __init__(self, model, max_wait_ms=MICROBATCH_WAIT_MS, max_batch=MICROBATCH_MAX_SIZE):
+        self.model = model
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        threading.Thread(target=self._worker, name="embedding-batcher", daemon=True).start()
+
+    def submit(self, text, is_query=False) -> Future:
+        future = Future()
+        self._queue.put((text, is_query, future))
+        return future
+
+    def _worker(self):
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(pending) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            self.batches += 1
+            self.requests += len(pending)
+            for is_query in (False, True):
+                group = [(text, future) for text, q, future in pending if q == is_query]
+                if not group:
+                    continue
+                try:
+                    embeddings = self.model._encode_and_cache([text for text, _ in group], is_query)
+                except Exception as e:
+                    for _, future in group:
+                        future.set_exception(e)
+                    continue
+                for (_, future), embedding in zip(group, embeddings):
+                    future.set_result(embedding)
 
+class SentenceTransformerBackend:
+    """Модель sentence-transformers на PyTorch (fp32, на GPU если есть)"""
+
+    def __init__(self, model_name):
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = self._load(model_name)
+
+    def _load(self, model_name):
+        return SentenceTransformer(model_name, device=self.device)
+
+    @property
+    def dim(self):
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts):
         with torch.no_grad():
-            embedding = self.model.encode(
-                text,
-                convert_to_tensor=True,
+            embeddings = self.model.encode(
+                texts,
+                batch_size=ENCODE_BATCH_SIZE,
+                convert_to_numpy=True,
                 normalize_embeddings=True
             )
-        return embedding.cpu().numpy().astype(np.float32).tobytes()
+        return np.asarray(embeddings, dtype=np.float32)
+
+class QuantizedTorchBackend(SentenceTransformerBackend):
+    """Динамическое int8-квантование линейных слоёв, только CPU"""
+
+    def _load(self, model_name):
+        self.device = "cpu"
+        model = SentenceTransformer(model_name, device=self.device)
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+class ExportedBackend(SentenceTransformerBackend):
+    """ONNX Runtime / OpenVINO через sentence-transformers (нужен optimum)"""
+
+    runtime = "onnx"
+
+    def _load(self, model_name):
+        self.device = "cpu"
+        model_kwargs = {"file_name": ONNX_FILE_NAME} if ONNX_FILE_NAME else None
+        return SentenceTransformer(
+            model_name,
+            device=self.device,
+            backend=self.runtime,
+            model_kwargs=model_kwargs
+        )
+
+class OpenVINOBackend(ExportedBackend):
+    runtime = "openvino"
+
+BACKENDS = {
+    "torch": SentenceTransformerBackend,
+    "torch-int8": QuantizedTorchBackend,
+    "onnx": ExportedBackend,
+    "openvino": OpenVINOBackend
+}
+
+class EmbeddingModel:
+    """Единственный экземпляр на процесс. Модель грузится не в конструкторе, а при
+    первом обращении или заранее в фоне через load_async(); ready — сигнал готовности.
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._setup()
+        return cls._instance
+
+    def _setup(self):
+        self.model_name = EMBEDDING_MODEL
+        self.backend = None
+        self.device = None
+        self.dim = None
+        self.batcher = None
+        self.load_time = None
+        self.cache = EmbeddingCache()
+        self.ready = threading.Event()
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        with self._load_lock:
+            if self.ready.is_set():
+                return
+            start = time.perf_counter()
+            self.backend = BACKENDS[EMBEDDING_BACKEND](EMBEDDING_MODEL)
+            self.device = self.backend.device
+            self.dim = self.backend.dim
+            self.batcher = EmbeddingBatcher(self) if USE_MICROBATCHING else None
+            self.load_time = time.perf_counter() - start
+            print(f"[EmbeddingModel] {EMBEDDING_MODEL} ({EMBEDDING_BACKEND}), устройство: {self.device}, загрузка {self.load_time:.1f} с")
+            self.ready.set()
+
+    def load_async(self, on_ready=None):
+        """Загружает модель в фоновом потоке; on_ready вызывается после загрузки"""
+        def run():
+            try:
+                self.load()
+            except Exception as e:
+                print(f"[EmbeddingModel] Ошибка загрузки модели: {e}")
+                return
+            if on_ready:
+                on_ready()
+
+        thread = threading.Thread(target=run, name="embedding-load", daemon=True)
+        thread.start()
+        return thread
+
+    def wait_ready(self):
+        if not self.ready.is_set():
+            self.load()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    def _encode(self, texts, is_query):
+        self.wait_ready()
+        prefix = "query: " if is_query else "passage: "
+        return self.backend.encode([prefix + text for text in texts])
+
+    def get_embeddings(self, texts, is_query: bool = False, use_cache: bool = True) -> np.ndarray:
+        """Матрица float32 (len(texts), dim); пустым текстам соответствуют нулевые строки"""
+        self.wait_ready()
+        result = np.zeros((len(texts), self.dim), dtype=np.float32)
+        missing = {}
+        for i, text in enumerate(texts):
+            text = self.normalize(text or "")
+            if not text:
+                continue
+            cached = self.cache.get((text, is_query)) if use_cache else None
+            if cached is not None:
+                result[i] = cached
+            else:
+                missing.setdefault(text, []).append(i)
+
+        if missing:
+            unique_texts = list(missing)
+            if use_cache:
+                encoded = self._encode_and_cache(unique_texts, is_query)
+            else:
+                encoded = self._encode(unique_texts, is_query)
+            for text, embedding in zip(unique_texts, encoded):
+                result[missing[text]] = embedding
+        return result
+
+    def _encode_and_cache(self, texts, is_query):
+        """Кодирует уже нормализованные тексты и кладёт результаты в кэш"""
+        embeddings = []
+        for text, embedding in zip(texts, self._encode(texts, is_query)):
+            embedding = embedding.copy()
+            embedding.setflags(write=False)
+            self.cache.put((text, is_query), embedding)
+            embeddings.append(embedding)
+        return embeddings
+
+    def embed(self, text: str, is_query: bool = False) -> np.ndarray | None:
+        """Эмбеддинг одного текста; при включённом микробатчинге идёт через общую очередь"""
+        text = self.normalize(text or "")
+        if not text:
+            return None
+
+        cached = self.cache.get((text, is_query))
+        if cached is not None:
+            return cached
+        self.wait_ready()
+        if self.batcher is not None:
+            return self.batcher.submit(text, is_query).result()
+        return self.get_embeddings([text], is_query=is_query)[0]
+
+    def get_embedding(self, text: str, is_query: bool = False) -> bytes | None:
+        embedding = self.embed(text, is_query=is_query)
+        if embedding is None:
+            return None
+        return embedding.tobytes()
 
     @staticmethod
     def blob_to_numpy(blob: bytes) -> np.ndarray:
         return np.frombuffer(blob, dtype=np.float32)
+
+
+def benchmark(count=256, concurrency=8):
+    """Сравнивает пропускную способность: по одному тексту, батчем и через микробатчер"""
+    model = EmbeddingModel()
+    model.wait_ready()
+    batcher = model.batcher or EmbeddingBatcher(model)
+    texts = [f"Тестовое сообщение номер {i} для замера скорости эмбеддингов" for i in range(count)]
+
+    def run(name, fn):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<22} {elapsed:8.2f} с  {count / elapsed:8.1f} текстов/с")
+
+    def single():
+        for text in texts:
+            model.get_embeddings([text], use_cache=False)
+
+    def batched():
+        for start in range(0, count, ENCODE_BATCH_SIZE):
+            model.get_embeddings(texts[start:start + ENCODE_BATCH_SIZE], use_cache=False)
+
+    def microbatched():
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(lambda text: batcher.submit(text).result(), texts))
+
+    model.get_embeddings(texts[:4], use_cache=False)
+    run("по одному", single)
+    run("батч", batched)
+    run(f"микробатч x{concurrency}", microbatched)
+    print(f"Батчей микробатчера: {batcher.batches}, запросов: {batcher.requests}")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,98 @@
+import hashlib
+import threading
+import time
+from config import DB_PATH
+from connections import connection
+
+# Сколько живут результаты по задачам (секунды). Оценка важности зависит от
+# текущей даты, она и так входит в ключ, поэтому хранится недолго
+LLM_CACHE_TTL = {
+    "sum": 30 * 86400,
+    "compress": 30 * 86400,
+    "rate": 2 * 86400
+}
+LLM_CACHE_DEFAULT_TTL = 7 * 86400
+LLM_CACHE_MAX_ENTRIES = 50000
+# Просроченные и лишние записи вычищаются раз в столько записей в кэш
+LLM_CACHE_EVICT_EVERY = 256
+
+class LLMCache:
+    """Кэш результатов детерминированных запросов к LLM в SQLite.
+
+    Ключ — (задача, модель, sha256 входного текста). Записи старше TTL задачи
+    не возвращаются, при переполнении удаляются давно не использованные.
+    Таблица создаётся миграцией db.MIGRATIONS в init_db.
+    """
+
+    def __init__(self, path=DB_PATH, max_entries=LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = {}
+        self.misses = {}
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(task, model, text):
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{task}:{model}:{digest}"
+
+    def get(self, task, model, text):
+        key = self.make_key(task, model, text)
+        now = time.time()
+        with connection(self.path) as conn:
+            row = conn.execute(
+                "SELECT value FROM llm_cache WHERE key = ? AND created_at > ?",
+                (key, now - LLM_CACHE_TTL.get(task, LLM_CACHE_DEFAULT_TTL))
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, key))
+
+        with self._lock:
+            counter = self.hits if row is not None else self.misses
+            counter[task] = counter.get(task, 0) + 1
+        return row[0] if row is not None else None
+
+    def put(self, task, model, text, value):
+        now = time.time()
+        with connection(self.path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, task, model, value, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.make_key(task, model, text), task, model, value, now, now)
+            )
+
+            with self._lock:
+                self._puts += 1
+                evict = self._puts % LLM_CACHE_EVICT_EVERY == 0
+            if evict:
+                self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        for task, ttl in LLM_CACHE_TTL.items():
+            conn.execute("DELETE FROM llm_cache WHERE task = ? AND created_at <= ?", (task, now - ttl))
+        conn.execute(
+            f"DELETE FROM llm_cache WHERE task NOT IN ({', '.join('?' * len(LLM_CACHE_TTL))}) AND created_at <= ?",
+            (*LLM_CACHE_TTL, now - LLM_CACHE_DEFAULT_TTL)
+        )
+        conn.execute('''
+            DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_entries,))
+
+    def stats(self):
+        with connection(self.path) as conn:
+            size = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        with self._lock:
+            tasks = set(self.hits) | set(self.misses)
+            by_task = {}
+            for task in sorted(tasks):
+                hits, misses = self.hits.get(task, 0), self.misses.get(task, 0)
+                by_task[task] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": hits / (hits + misses) if hits + misses else 0.0
+                }
+        return {"size": size, "tasks": by_task}
+
+llm_cache = LLMCache()
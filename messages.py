@@ -1,112 +1,376 @@
-import sqlite3
-from config import HEADER, DB_PATH, MODEL
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import HEADER, MODEL
+from background import KeyedWorkerPool
+from connections import close_connections
 from db import (
     add_to_context, 
     search_context, 
-    clear_context, 
-    delete_from_long_term, 
+    apply_long_term_prune, 
     save_to_long_term, 
-    get_full_context, 
+    get_context_snapshot, 
+    delete_context_up_to, 
     get_long_term_memory_prune,
-    search_memories
+    search_memories,
+    embed_query,
+    get_chat_ids,
+    get_idle_chats,
+    mark_offloaded
 )
-from ai_client import query_openrouter, summarize_message, is_important_fact, compress_to_long_term
+from ai_client import query_openrouter, stream_openrouter, summarize_messages, rate_facts, IMPORTANCE_THRESHOLD, compress_facts, count_tokens, key_pool
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
-user_chats = set()
+# Потоковый ответ: первое сообщение уходит с первыми токенами, дальше оно
+# редактируется не чаще раза в STREAM_EDIT_INTERVAL секунд
+STREAM_REPLIES = True
+STREAM_EDIT_INTERVAL = 1.5
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Сколько раз повторяется окончательная правка сообщения при 429 от Telegram
+# и сколько секунд из retry_after готовы ждать; дальше остаток уходит новым сообщением
+FINAL_EDIT_ATTEMPTS = 3
+FINAL_EDIT_MAX_WAIT = 30
+
+# Сколько токенов промпта отдаётся под найденные воспоминания и реплики
+CONTEXT_TOKEN_BUDGET = 1500
+
+MEMORY_HEADER = "Релевантные воспоминания из прошлых разговоров (используйте только если уместно):"
+CONTEXT_HEADER = "Релевантные реплики из текущего разговора:"
+
+# Сжатие и сохранение реплик идёт в фоне уже после отправки ответа;
+# реплики одного пользователя сохраняются строго по порядку
+POST_PROCESS_WORKERS = 4
+POST_PROCESS_QUEUE_SIZE = 256
+
+# Сколько пользователей выгружается в долговременную память одновременно;
+# частоту фоновых запросов к API можно ограничить через ai_client.KEY_RATE_LIMIT
+OFFLOAD_CONCURRENCY = 4
+
+# Контекст пользователя выгружается после OFFLOAD_IDLE_MINUTES без сообщений;
+# за один проход планировщика — не больше OFFLOAD_MAX_PER_RUN пользователей
+OFFLOAD_IDLE_MINUTES = 60
+OFFLOAD_MAX_PER_RUN = 20
+
+_offload_lock = threading.Lock()
+
+# Важность фактов 6-8 убывает на 1 каждые DECAY_DAYS дней с последней оценки.
+# К LLM на переоценку идут только факты, опустившиеся ниже порога не более
+# чем на PRUNE_LLM_MARGIN; упавшие ниже удаляются без запроса
+DECAY_DAYS = 5
+PRUNE_LLM_MARGIN = 2
+post_processor = KeyedWorkerPool("post-process", workers=POST_PROCESS_WORKERS, queue_size=POST_PROCESS_QUEUE_SIZE)
+
+def _format_line(role, summary):
+    speaker = "Пользователь" if role == "user" else "Вы"
+    return f"- {speaker}: {summary}"
+
+def build_context_messages(memories, context_results, budget=CONTEXT_TOKEN_BUDGET, model=MODEL):
+    """Собирает блоки воспоминаний и реплик в пределах бюджета токенов.
+
+    memories: [(role, summary, score)], context_results: [(role, summary, timestamp, score)].
+    Строки берутся по убыванию score, пока помещаются; воспоминания выводятся
+    по релевантности, реплики — в хронологическом порядке.
+    """
+    candidates = [
+        (score, "memory", _format_line(role, summary), None)
+        for role, summary, score in memories
+    ] + [
+        (score, "context", _format_line(role, summary), timestamp)
+        for role, summary, timestamp, score in context_results
+    ]
+    candidates.sort(key=lambda c: c[0], reverse=True)
+
+    headers = {"memory": MEMORY_HEADER, "context": CONTEXT_HEADER}
+    chosen = {"memory": [], "context": []}
+    used = 0
+    for score, kind, line, timestamp in candidates:
+        cost = count_tokens(line, model=model)
+        if not chosen[kind]:
+            cost += count_tokens(headers[kind], model=model)
+        if used + cost > budget:
+            continue
+        used += cost
+        chosen[kind].append((timestamp, line))
+
+    chosen["context"].sort(key=lambda item: datetime.fromisoformat(item[0]))
+
+    return [
+        {"role": "user", "content": headers[kind] + "\n" + "\n".join(line for _, line in chosen[kind])}
+        for kind in ("memory", "context") if chosen[kind]
+    ]
+
+def _retry_after(error):
+    """retry_after из ответа Telegram 429, если он есть"""
+    result = getattr(error, "result_json", None) or {}
+    return (result.get("parameters") or {}).get("retry_after")
+
+def _finish_message(bot, chat_id, message_id, text, shown):
+    """Доводит уже отправленное сообщение (в нём shown) до text. Правка повторяется
+    с учётом retry_after; если не удалась, недостающий хвост отправляется новым сообщением"""
+    for attempt in range(FINAL_EDIT_ATTEMPTS):
+        try:
+            bot.edit_message_text(text, chat_id, message_id)
+            return
+        except Exception as e:
+            if "message is not modified" in str(e):
+                return
+            delay = _retry_after(e)
+            print(f"[Ошибка редактирования] {e}")
+            if delay is None or delay > FINAL_EDIT_MAX_WAIT or attempt == FINAL_EDIT_ATTEMPTS - 1:
+                break
+            time.sleep(delay)
+
+    bot.send_message(chat_id, text[len(shown):] if text.startswith(shown) else text)
+
+def stream_reply(bot, chat_id, chunks):
+    """Отправляет ответ по мере генерации, редактируя сообщение; возвращает полный текст"""
+    text = ""
+    message_id = None
+    message_start = 0
+    shown = ""
+    last_edit = 0.0
+
+    def show(final=False):
+        nonlocal message_id, message_start, shown, last_edit
+        # Переполненное сообщение закрывается, продолжение идёт новым
+        while len(text) - message_start > TELEGRAM_MESSAGE_LIMIT:
+            part = text[message_start:message_start + TELEGRAM_MESSAGE_LIMIT]
+            if message_id is None:
+                bot.send_message(chat_id, part)
+            elif part != shown:
+                _finish_message(bot, chat_id, message_id, part, shown)
+            message_id = None
+            message_start += TELEGRAM_MESSAGE_LIMIT
+            shown = ""
+
+        current = text[message_start:]
+        if not current.strip() or current == shown:
+            return
+        if not final and time.monotonic() - last_edit < STREAM_EDIT_INTERVAL:
+            return
+        if message_id is None:
+            message_id = bot.send_message(chat_id, current).message_id
+        elif final:
+            _finish_message(bot, chat_id, message_id, current, shown)
+        else:
+            try:
+                bot.edit_message_text(current, chat_id, message_id)
+            except Exception as e:
+                print(f"[Ошибка редактирования] {e}")
+                return
+        shown = current
+        last_edit = time.monotonic()
+
+    for chunk in chunks:
+        text += chunk
+        show()
+    show(final=True)
+
+    if not text.strip():
+        raise Exception("Пустой потоковый ответ OpenRouter")
+    return text
 
 def handle_message_as_bot(bot, chat_id, text):
     user_id = chat_id
-    user_chats.add(user_id)
 
     try:
         now = datetime.utcnow()
         readable_stamp = now.strftime("%d.%m %H:%M")
 
-        formatted_context = []
-
-        long_term_results = search_memories(user_id, text)
-        if long_term_results:
-            memory_lines = []
-            for role, summary in long_term_results:
-                speaker = "Пользователь" if role == "user" else "Вы"
-                memory_lines.append(f"- {speaker}: {summary}")
-            memory_block = "\n".join(memory_lines)
-            formatted_context.append({
-                "role": "user",
-                "content": f"Релевантные воспоминания из прошлых разговоров (используйте только если уместно):\n{memory_block}"
-            })
-
-        context_results = search_context(user_id, text)
-        if context_results:
-            context_results.sort(key=lambda x: datetime.fromisoformat(x[2]))
-            context_lines = []
-            for role, summary, _ in context_results:
-                speaker = "Пользователь" if role == "user" else "Вы"
-                context_lines.append(f"- {speaker}: {summary}")
-            context_block = "\n".join(context_lines)
-            formatted_context.append({
-                "role": "user",
-                "content": f"Релевантные реплики из текущего разговора:\n{context_block}"
-            })
+        query_vec = embed_query(text)
 
-        prompt = f"Пользователь написал [{readable_stamp}]: {text}\nВы отвечаете без указания времени:"
+        long_term_results = search_memories(user_id, text, query_vec=query_vec)
+        context_results = search_context(user_id, text, query_vec=query_vec)
+        formatted_context = build_context_messages(long_term_results, context_results)
 
-        reply = query_openrouter(
-            prompt=prompt,
-            context_messages=formatted_context,
-            system_prompt=HEADER
-        )
+        prompt = f"Пользователь написал [{readable_stamp}]: {text}\nВы отвечаете без указания времени:"
 
-        if len(text.split()) < 12:
-            summarized = text
+        if STREAM_REPLIES:
+            reply = stream_reply(bot, chat_id, stream_openrouter(
+                prompt=prompt,
+                context_messages=formatted_context,
+                system_prompt=HEADER
+            ))
         else:
-            summarized = summarize_message(text)
-        add_to_context(user_id, "user", text, summarized)
+            reply = query_openrouter(
+                prompt=prompt,
+                context_messages=formatted_context,
+                system_prompt=HEADER
+            )
 
-        bot_summary = summarize_message(reply)
-        add_to_context(user_id, "assistant", reply, bot_summary)
-        bot.send_message(chat_id, reply)
+        if not STREAM_REPLIES:
+            bot.send_message(chat_id, reply)
 
     except Exception as e:
         bot.send_message(chat_id, "Произошла ошибка при обработке ответа.")
         print(f"[Ошибка OpenRouter]: {e}")
+        return
 
-def offload_context_to_long_term():
-    for user_id in user_chats:
-        rows = get_full_context(user_id)
-        for role, summary, content, timestamp in rows:
-            try:
-                dt = datetime.fromisoformat(timestamp)
-                date_str = dt.date().isoformat()
-            except Exception:
-                date_str = datetime.utcnow().date().isoformat()
-            is_important, rate = is_important_fact(summary, date_str)
-            if is_important:
-                compressed = compress_to_long_term(summary, date_str)
-                save_to_long_term(user_id, role, content, compressed, rate)
-        clear_context(user_id)
+    post_processor.submit(user_id, persist_turn, user_id, text, reply)
+
+def persist_turn(user_id, text, reply):
+    """Сжимает и сохраняет в контекст реплику пользователя и ответ бота;
+    короткие реплики пользователя не сжимаются, остальное — одним запросом"""
+    try:
+        if len(text.split()) >= 12:
+            summarized, bot_summary = summarize_messages([text, reply])
+        else:
+            summarized, bot_summary = text, *summarize_messages([reply])
+    except Exception as e:
+        # Без сжатия реплики сохраняются целиком, как короткие, — но не теряются
+        print(f"[persist_turn] Ошибка сжатия, сохраняется исходный текст: {e}")
+        summarized, bot_summary = text, reply
+    add_to_context(user_id, "user", text, (summarized or "").strip() or text)
+    add_to_context(user_id, "assistant", reply, (bot_summary or "").strip() or reply)
+
+def offload_user(user_id):
+    """Переносит важное из контекста пользователя в долговременную память;
+    возвращает число сохранённых фактов. Контекст очищается только при успехе"""
+    started_at = datetime.utcnow().isoformat()
+    rows = get_context_snapshot(user_id)
+    if not rows:
         prune_long_term_memory(user_id)
+        mark_offloaded(user_id, started_at)
+        return 0
+
+    dated = []
+    for _, role, summary, content, timestamp in rows:
+        try:
+            dt = datetime.fromisoformat(timestamp)
+            date_str = dt.date().isoformat()
+        except Exception:
+            date_str = datetime.utcnow().date().isoformat()
+        dated.append((summary, date_str))
+
+    # Оценка и сжатие — пакетами: несколько запросов на пользователя вместо трёх на реплику
+    ratings = rate_facts(dated)
+    # Реплики, которые не удалось оценить, и всё после них остаются в контексте
+    # до следующего прохода: выгружается только начало снимка до первой такой
+    unrated = next((i for i, (_, rate) in enumerate(ratings) if rate is None), None)
+    if unrated is not None:
+        rows, ratings = rows[:unrated], ratings[:unrated]
+
+    important = [
+        (role, content, summary, rate)
+        for (_, role, summary, content, _), (is_important, rate) in zip(rows, ratings)
+        if is_important
+    ]
+    compressed = compress_facts([summary for _, _, summary, _ in important])
+    for (role, content, _, rate), fact in zip(important, compressed):
+        save_to_long_term(user_id, role, content, fact, rate)
+    # Удаляется только снимок: реплики, сохранённые persist_turn за время выгрузки,
+    # остаются, и чат не помечается выгруженным, чтобы их забрал следующий проход
+    remaining = delete_context_up_to(user_id, rows[-1][0]) if rows else None
+    prune_long_term_memory(user_id)
+    if unrated is not None:
+        # Ошибка попадает в отчёт прохода, чат остаётся в очереди на выгрузку
+        raise Exception(f"Не удалось оценить {len(dated) - unrated} реплик, они остались в контексте")
+    if not remaining:
+        mark_offloaded(user_id, started_at)
+    return len(important)
+
+def _api_requests():
+    return sum(stats["requests"] for stats in key_pool.stats().values())
+
+def _offload_user_in_pool(user_id):
+    """offload_user в потоке пула: потоки пула завершаются вместе с проходом,
+    поэтому их соединения SQLite закрываются сразу, а не сборщиком мусора"""
+    try:
+        return offload_user(user_id)
+    finally:
+        close_connections()
+
+def offload_context_to_long_term(user_ids=None, concurrency=OFFLOAD_CONCURRENCY):
+    """Выгружает контекст пользователей параллельно; ошибка одного пользователя
+    не останавливает остальных. Возвращает сводку с метриками прохода"""
+    users = list(get_chat_ids() if user_ids is None else user_ids)
+    if not users:
+        return {"users": 0, "done": 0, "failed": [], "facts": 0, "requests": 0, "elapsed": 0.0}
+
+    start = time.monotonic()
+    requests_before = _api_requests()
+    done = 0
+    facts = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="offload") as pool:
+        futures = {pool.submit(_offload_user_in_pool, user_id): user_id for user_id in users}
+        for future in as_completed(futures):
+            user_id = futures[future]
+            try:
+                facts += future.result()
+                done += 1
+            except Exception as e:
+                failed.append(user_id)
+                print(f"[Offload] Ошибка для пользователя {user_id}: {e}")
+
+            finished = done + len(failed)
+            elapsed = time.monotonic() - start
+            print(f"[Offload] {finished}/{len(users)} пользователей, {finished / elapsed * 60:.1f} польз./мин")
+
+    elapsed = time.monotonic() - start
+    report = {
+        "users": len(users),
+        "done": done,
+        "failed": failed,
+        "facts": facts,
+        "requests": _api_requests() - requests_before,
+        "elapsed": round(elapsed, 1)
+    }
+    print(f"[Offload] Готово за {report['elapsed']} с: {done} успешно, {len(failed)} с ошибкой, "
+          f"фактов сохранено {facts}, запросов к API {report['requests']} ({report['requests'] / elapsed:.2f}/с)")
+    return report
+
+def offload_idle_chats(idle_minutes=OFFLOAD_IDLE_MINUTES, max_users=OFFLOAD_MAX_PER_RUN):
+    """Выгружает только давно молчащих пользователей; вызывается планировщиком.
+    Если предыдущий проход ещё идёт, ничего не делает"""
+    if not _offload_lock.acquire(blocking=False):
+        return None
+    try:
+        idle_since = (datetime.utcnow() - timedelta(minutes=idle_minutes)).isoformat()
+        users = get_idle_chats(idle_since, limit=max_users)
+        if not users:
+            return None
+        return offload_context_to_long_term(users)
+    finally:
+        _offload_lock.release()
+
+def decayed_rate(rate, since, today=None):
+    """Текущая важность по правилу из промпта оценки: 9-10 не стареют,
+    остальные теряют балл за каждые DECAY_DAYS дней с даты since (ISO)"""
+    if rate >= 9:
+        return rate
+    today = today or datetime.utcnow().date()
+    try:
+        age = (today - datetime.fromisoformat(since).date()).days
+    except (TypeError, ValueError):
+        age = 0
+    return rate - max(0, age) // DECAY_DAYS
 
 def prune_long_term_memory(user_id):
-    for summary, date, rate in get_long_term_memory_prune(user_id):
-        if rate >= 9:
+    today = datetime.utcnow().date()
+    deleted = []
+    borderline = []
+    for row_id, summary, date, rate, rated_at in get_long_term_memory_prune(user_id):
+        rate = rate or 0
+        current = decayed_rate(rate, rated_at or date, today)
+        if current >= IMPORTANCE_THRESHOLD:
             continue
-
-        is_important, new_rate = is_important_fact(summary, date)
-        if not is_important:
-            delete_from_long_term(user_id, summary)
+        if current >= IMPORTANCE_THRESHOLD - PRUNE_LLM_MARGIN and rate >= IMPORTANCE_THRESHOLD:
+            borderline.append((row_id, summary, date))
         else:
-            if new_rate != rate:
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute(
-                    "UPDATE long_term_memory SET rate = ? WHERE user_id = ? AND summary = ?",
-                    (new_rate, user_id, summary)
-                )
-                conn.commit()
-                conn.close()
+            deleted.append(row_id)
+
+    rate_updates = []
+    ratings = rate_facts([(summary, date) for _, summary, date in borderline])
+    for (row_id, _, _), (is_important, new_rate) in zip(borderline, ratings):
+        if is_important:
+            rate_updates.append((row_id, new_rate))
+        elif new_rate is not None:
+            deleted.append(row_id)
+
+    if rate_updates or deleted:
+        apply_long_term_prune(user_id, rate_updates, deleted)
 
 def get_user_chats():
-    return user_chats
\ No newline at end of file
+    return get_chat_ids()
\ No newline at end of file
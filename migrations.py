@@ -0,0 +1,28 @@
+def add_column(conn, table, column, definition):
+    """ALTER TABLE ADD COLUMN, если такой колонки ещё нет"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def migrate(conn, migrations, name):
+    """Применяет миграции, которых ещё не было в базе.
+
+    migrations — список функций migration(conn); номер миграции — её позиция
+    в списке начиная с 1, применённый номер хранится в PRAGMA user_version.
+    Каждая миграция идёт в своей транзакции вместе с обновлением номера.
+    Базы, созданные до появления миграций (user_version = 0), проходят все
+    миграции, поэтому они должны выдерживать уже существующую схему.
+    """
+    conn.commit()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(migrations[version:], version + 1):
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        print(f"[Миграции] {name}: {number} {migration.__name__}")
+    return len(migrations)
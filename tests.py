@@ -1,14 +1,14 @@
 import json
-import sqlite3
 from datetime import datetime
 from ai_client import query_openrouter
 from config import DEEP_MODEL
+from connections import connection
+from migrations import migrate
 
-def init_tests_db():
-    conn = sqlite3.connect('chat_sessions.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
+SESSIONS_DB_PATH = 'chat_sessions.db'
+
+def _create_test_tables(conn):
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS test_sessions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER NOT NULL,
@@ -20,7 +20,7 @@ def init_tests_db():
         )
     ''')
     
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS test_results (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER NOT NULL,
@@ -30,9 +30,19 @@ def init_tests_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
-    conn.commit()
-    conn.close()
+
+def _add_test_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_test_sessions_chat ON test_sessions (chat_id, is_completed)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_test_results_chat ON test_results (chat_id, test_name, created_at)")
+
+SESSIONS_MIGRATIONS = [
+    _create_test_tables,
+    _add_test_indexes
+]
+
+def init_tests_db():
+    with connection(SESSIONS_DB_PATH) as conn:
+        migrate(conn, SESSIONS_MIGRATIONS, "sessions")
 
 init_tests_db()
 
@@ -174,40 +184,36 @@ class TestManager:
         if test_name not in TESTS:
             return None
         
-        conn = sqlite3.connect('chat_sessions.db')
-        cursor = conn.cursor()
+        with connection(SESSIONS_DB_PATH) as conn:
+            cursor = conn.cursor()
         
-        cursor.execute(
-            'UPDATE test_sessions SET is_completed = TRUE WHERE chat_id = ? AND is_completed = FALSE',
-            (chat_id,)
-        )
+            cursor.execute(
+                'UPDATE test_sessions SET is_completed = TRUE WHERE chat_id = ? AND is_completed = FALSE',
+                (chat_id,)
+            )
 
-        cursor.execute(
-            'INSERT INTO test_sessions (chat_id, test_name) VALUES (?, ?)',
-            (chat_id, test_name)
-        )
-        session_id = cursor.lastrowid
-        
-        conn.commit()
-        conn.close()
+            cursor.execute(
+                'INSERT INTO test_sessions (chat_id, test_name) VALUES (?, ?)',
+                (chat_id, test_name)
+            )
+            session_id = cursor.lastrowid
         
         return session_id
     
     def get_current_question(self, chat_id):
         """Получает текущий вопрос для пользователя"""
-        conn = sqlite3.connect('chat_sessions.db')
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            '''SELECT ts.id, ts.test_name, ts.current_question, ts.answers, ts.is_completed 
-               FROM test_sessions ts 
-               WHERE ts.chat_id = ? AND ts.is_completed = FALSE 
-               ORDER BY ts.id DESC LIMIT 1''',
-            (chat_id,)
-        )
+        with connection(SESSIONS_DB_PATH) as conn:
+            cursor = conn.cursor()
+        
+            cursor.execute(
+                '''SELECT ts.id, ts.test_name, ts.current_question, ts.answers, ts.is_completed 
+                   FROM test_sessions ts 
+                   WHERE ts.chat_id = ? AND ts.is_completed = FALSE 
+                   ORDER BY ts.id DESC LIMIT 1''',
+                (chat_id,)
+            )
         
-        session = cursor.fetchone()
-        conn.close()
+            session = cursor.fetchone()
         
         if not session:
             return None
@@ -232,42 +238,38 @@ class TestManager:
     
     def save_answer(self, session_id, answer_index):
         """Сохраняет ответ и переходит к следующему вопросу"""
-        conn = sqlite3.connect('chat_sessions.db')
-        cursor = conn.cursor()
-        
-        # Получаем текущее состояние
-        cursor.execute(
-            'SELECT chat_id, test_name, current_question, answers FROM test_sessions WHERE id = ?',
-            (session_id,)
-        )
-        session = cursor.fetchone()
+        with connection(SESSIONS_DB_PATH) as conn:
+            cursor = conn.cursor()
         
-        if not session:
-            conn.close()
-            return False
+            # Получаем текущее состояние
+            cursor.execute(
+                'SELECT chat_id, test_name, current_question, answers FROM test_sessions WHERE id = ?',
+                (session_id,)
+            )
+            session = cursor.fetchone()
         
-        chat_id, test_name, current_question, answers_json = session
-        answers = json.loads(answers_json)
+            if not session:
+                return False
         
-        answers.append({
-            'question_index': current_question,
-            'answer_index': answer_index,
-            'timestamp': datetime.now().isoformat()
-        })
+            chat_id, test_name, current_question, answers_json = session
+            answers = json.loads(answers_json)
         
-        test_questions = TESTS[test_name]['questions']
-        next_question = current_question + 1
-        is_completed = next_question >= len(test_questions)
+            answers.append({
+                'question_index': current_question,
+                'answer_index': answer_index,
+                'timestamp': datetime.now().isoformat()
+            })
         
-        cursor.execute(
-            '''UPDATE test_sessions 
-               SET current_question = ?, answers = ?, is_completed = ?
-               WHERE id = ?''',
-            (next_question, json.dumps(answers), is_completed, session_id)
-        )
+            test_questions = TESTS[test_name]['questions']
+            next_question = current_question + 1
+            is_completed = next_question >= len(test_questions)
         
-        conn.commit()
-        conn.close()
+            cursor.execute(
+                '''UPDATE test_sessions 
+                   SET current_question = ?, answers = ?, is_completed = ?
+                   WHERE id = ?''',
+                (next_question, json.dumps(answers), is_completed, session_id)
+            )
         
         if is_completed:
             self._complete_test(session_id, chat_id, test_name, answers)
@@ -294,17 +296,14 @@ class TestManager:
         
         analysis = self._analyze_with_ai(analysis_data)
         
-        conn = sqlite3.connect('chat_sessions.db')
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            '''INSERT INTO test_results (chat_id, test_name, answers, analysis)
-               VALUES (?, ?, ?, ?)''',
-            (chat_id, test_name, json.dumps(analysis_data), analysis)
-        )
+        with connection(SESSIONS_DB_PATH) as conn:
+            cursor = conn.cursor()
         
-        conn.commit()
-        conn.close()
+            cursor.execute(
+                '''INSERT INTO test_results (chat_id, test_name, answers, analysis)
+                   VALUES (?, ?, ?, ?)''',
+                (chat_id, test_name, json.dumps(analysis_data), analysis)
+            )
         
         return analysis
     
@@ -338,18 +337,17 @@ class TestManager:
     
     def get_test_result(self, chat_id, test_name):
         """Получает результат последнего теста"""
-        conn = sqlite3.connect('chat_sessions.db')
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            '''SELECT analysis, created_at FROM test_results 
-               WHERE chat_id = ? AND test_name = ? 
-               ORDER BY created_at DESC LIMIT 1''',
-            (chat_id, test_name)
-        )
+        with connection(SESSIONS_DB_PATH) as conn:
+            cursor = conn.cursor()
+        
+            cursor.execute(
+                '''SELECT analysis, created_at FROM test_results 
+                   WHERE chat_id = ? AND test_name = ? 
+                   ORDER BY created_at DESC LIMIT 1''',
+                (chat_id, test_name)
+            )
         
-        result = cursor.fetchone()
-        conn.close()
+            result = cursor.fetchone()
         
         if result:
             return {
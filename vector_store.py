@@ -1,67 +1,581 @@
 import os
+import json
+import atexit
+import queue
+import shutil
+import struct
+import threading
+import time
+import zlib
+from array import array
 import faiss
 import numpy as np
 import pickle
 
-VECTOR_DIM = 1024
-INDEX_PATH = "data/faiss_index.bin"
-META_PATH = "data/metadata.pkl"
+STORE_DIR = "data/vectors"
+# Единый индекс и метаданные до разделения на пользователей; в metadata.pkl
+# лежат тексты всех сообщений. Векторы строятся заново из SQLite, файлы удаляются
+LEGACY_FILES = ("data/faiss_index.bin", "data/metadata.pkl")
 
-class VectorStore:
-    def __init__(self):
-        self.index = None
-        self.metadata = [] 
-        if os.path.exists(INDEX_PATH):
+# Чекпоинт (полная запись изменённых подындексов) делается, когда журнал
+# дорастает до одного из порогов; между чекпоинтами пишется только журнал
+CHECKPOINT_EVERY = 1000
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+JOURNAL_FSYNC = True
+
+# Подындекс уплотняется в фоне, когда удалённых векторов в нём больше этой доли
+COMPACT_RATIO = 0.25
+
+# Тип индекса для больших подындексов: "flat" (точный перебор), "hnsw" или "ivf".
+# Пока в подындексе меньше ANN_THRESHOLD векторов, он остаётся плоским, при
+# пересечении порога фоном перестраивается в выбранный тип
+INDEX_TYPE = "flat"
+ANN_THRESHOLD = 20000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+IVF_NPROBE = 16
+
+# Подындексы читаются с диска только при первом обращении к пользователю.
+# С MMAP_LOAD индекс (faiss с IO_FLAG_MMAP_IFC) и массив id отображаются в
+# память без копирования; в RAM они копируются только перед первой записью
+MMAP_LOAD = True
+_MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+_RECORD_HEADER = struct.Struct("<II")
+
+def index_kind(index):
+    if hasattr(index, "hnsw"):
+        return "hnsw"
+    if hasattr(index, "nprobe"):
+        return "ivf"
+    return "flat"
+
+def ivf_nlist(size):
+    return max(1, int(4 * np.sqrt(size)))
+
+def tune_index(index, ef_search=None, nprobe=None):
+    """Поисковые параметры ANN-индексов (efSearch для HNSW, nprobe для IVF)"""
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search or HNSW_EF_SEARCH
+    if hasattr(index, "nprobe"):
+        index.nprobe = nprobe or IVF_NPROBE
+    return index
+
+def build_index(kind, dim, vectors):
+    """Строит индекс заданного типа по матрице векторов (IVF обучается на них же)"""
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif kind == "ivf":
+        nlist = min(ivf_nlist(len(vectors)), len(vectors))
+        index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        # Нужна для reconstruct_n при уплотнении
+        index.make_direct_map()
+    else:
+        index = faiss.IndexFlatIP(dim)
+    tune_index(index)
+    if len(vectors):
+        index.add(vectors)
+    return index
+
+def target_kind(size):
+    return INDEX_TYPE if size >= ANN_THRESHOLD else "flat"
+
+class Collection:
+    """Коллекция векторов, разбитая на отдельные подындексы по user_id.
+
+    Хранит только векторы и их vector_id (массив int64 на подындекс);
+    сами записи лежат в SQLite и ищутся там по vector_id.
+
+    Новые векторы дописываются в журнал (journal.log), подындексы на диск
+    пишутся только при чекпоинте. manifest.pkl фиксирует, какие файлы
+    подындексов актуальны и до какой записи журнала они доведены.
+
+    Удаление только помечает id (tombstone), такие векторы отбрасываются
+    при поиске, а физически вычищаются фоновым уплотнением.
+
+    При открытии читаются только манифест и журнал; подындекс загружается
+    при первом обращении к его пользователю.
+    """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.manifest_path = os.path.join(path, "manifest.pkl")
+        self.journal_path = os.path.join(path, "journal.log")
+        self.partitions = {}
+        self.ids = {}
+        self.tombstones = {}
+        self._unloaded = set()
+        self._mapped = set()
+        self._lock = threading.RLock()
+        self._seq = 0
+        self._next_id = 0
+        self._generation = 0
+        self._files = {}
+        self._dirty = set()
+        self._journal_records = 0
+        self._compact_queue = queue.Queue()
+        self._compact_pending = set()
+
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(self.manifest_path):
             self._load()
+        self._replay_journal()
+        self._journal = open(self.journal_path, "ab")
+        atexit.register(self.checkpoint)
+
+        threading.Thread(target=self._compaction_worker, name=f"vector-compaction-{name}", daemon=True).start()
+
+    def _partition_path(self, user_id, generation, ext):
+        return os.path.join(self.path, f"{user_id}.{generation}.{ext}")
+
+    @staticmethod
+    def _read_ids(path, mmap=False):
+        if mmap and os.path.getsize(path):
+            return np.memmap(path, dtype=np.int64, mode="r")
+        ids = array("q")
+        with open(path, "rb") as f:
+            ids.frombytes(f.read())
+        return ids
+
+    @staticmethod
+    def _write_ids(path, ids):
+        with open(path, "wb") as f:
+            ids.tofile(f)
 
     def _load(self):
-        self.index = faiss.read_index(INDEX_PATH)
-        with open(META_PATH, "rb") as f:
-            self.metadata = pickle.load(f)
+        with open(self.manifest_path, "rb") as f:
+            manifest = pickle.load(f)
+        self._seq = manifest["seq"]
+        self._next_id = manifest["next_id"]
+        self._generation = manifest["generation"]
+        self._files = manifest["partitions"]
+        self._unloaded = set(self._files)
+
+    def _ensure_loaded(self, user_id):
+        """Подгружает подындекс с диска при первом обращении; None, если его нет"""
+        if user_id in self._unloaded:
+            self._unloaded.discard(user_id)
+            generation = self._files[user_id]
+            mmap = MMAP_LOAD and bool(_MMAP_FLAGS)
+            index = faiss.read_index(self._partition_path(user_id, generation, "bin"), _MMAP_FLAGS if mmap else 0)
+            self.partitions[user_id] = tune_index(index)
+            self.ids[user_id] = self._read_ids(self._partition_path(user_id, generation, "ids"), mmap=MMAP_LOAD)
+            self.tombstones[user_id] = set(self._read_ids(self._partition_path(user_id, generation, "del")))
+            if mmap:
+                self._mapped.add(user_id)
+        return self.partitions.get(user_id)
+
+    def _materialize(self, user_id):
+        """Копирует отображённый в память подындекс в RAM, чтобы в него можно было писать"""
+        if user_id in self._mapped:
+            self._mapped.discard(user_id)
+            path = self._partition_path(user_id, self._files[user_id], "bin")
+            self.partitions[user_id] = tune_index(faiss.read_index(path))
+        if not isinstance(self.ids[user_id], array):
+            ids = array("q")
+            ids.frombytes(self.ids[user_id].tobytes())
+            self.ids[user_id] = ids
+
+    def user_ids(self):
+        with self._lock:
+            return set(self.partitions) | self._unloaded
+
+    def _replay_journal(self):
+        """Доигрывает записи журнала, сделанные после последнего чекпоинта"""
+        if not os.path.exists(self.journal_path):
+            return
+
+        replayed = 0
+        skipped = 0
+        with open(self.journal_path, "r+b") as f:
+            good_offset = 0
+            while True:
+                header = f.read(_RECORD_HEADER.size)
+                if len(header) < _RECORD_HEADER.size:
+                    break
+                length, crc = _RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                good_offset = f.tell()
+
+                seq, op, user_id, data = pickle.loads(payload)
+                self._journal_records += 1
+                if seq <= self._seq:
+                    continue
+                try:
+                    if op == "add":
+                        vector_id, emb_bytes = data
+                        self._next_id = max(self._next_id, vector_id + 1)
+                        self._apply_add(user_id, vector_id, np.frombuffer(emb_bytes, dtype=np.float32))
+                    elif op == "delete":
+                        self._apply_delete(user_id, data)
+                    elif op == "drop":
+                        self._apply_drop(user_id)
+                    replayed += 1
+                except Exception as e:
+                    # Запись, которую нельзя применить, пропускается, а не блокирует коллекцию
+                    skipped += 1
+                    print(f"[VectorStore:{self.name}] Пропущена запись журнала {seq} ({op}, {user_id}): {e!r}")
+                self._seq = seq
 
-    def _save(self):
-        if self.index:
-            faiss.write_index(self.index, INDEX_PATH)
-        with open(META_PATH, "wb") as f:
-            pickle.dump(self.metadata, f)
+            # Обрезаем недописанный хвост, оставшийся после падения
+            f.truncate(good_offset)
 
-    def _create_index(self):
-        self.index = faiss.IndexFlatIP(VECTOR_DIM)
+        if replayed:
+            print(f"[VectorStore:{self.name}] Из журнала восстановлено записей: {replayed}")
+        if skipped:
+            print(f"[VectorStore:{self.name}] Пропущено неприменимых записей журнала: {skipped}")
 
-    def add(self, embedding: np.ndarray, meta: dict):
-        if self.index is None:
-            self._create_index()
+    def _append(self, op, user_id, data):
+        self._seq += 1
+        payload = pickle.dumps((self._seq, op, user_id, data), protocol=pickle.HIGHEST_PROTOCOL)
+        self._journal.write(_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._journal.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(self._journal.fileno())
+        self._journal_records += 1
+
+    def _write_checkpoint(self):
+        self._generation += 1
+        obsolete = []
+        for user_id in self._dirty:
+            if user_id in self._files:
+                obsolete.append((user_id, self._files.pop(user_id)))
+            if user_id not in self.partitions:
+                continue
+            faiss.write_index(self.partitions[user_id], self._partition_path(user_id, self._generation, "bin"))
+            self._write_ids(self._partition_path(user_id, self._generation, "ids"), self.ids[user_id])
+            self._write_ids(self._partition_path(user_id, self._generation, "del"), array("q", self.tombstones[user_id]))
+            self._files[user_id] = self._generation
+
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({
+                "seq": self._seq,
+                "next_id": self._next_id,
+                "generation": self._generation,
+                "partitions": self._files
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+        self._dirty.clear()
+
+        for user_id, generation in obsolete:
+            for ext in ("bin", "ids", "del"):
+                path = self._partition_path(user_id, generation, ext)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def checkpoint(self):
+        """Записывает изменённые подындексы и очищает журнал"""
+        with self._lock:
+            if self._journal.closed or (not self._dirty and not self._journal_records):
+                return
+            self._write_checkpoint()
+            self._journal.seek(0)
+            self._journal.truncate()
+            self._journal_records = 0
+
+    def _maybe_checkpoint(self):
+        if self._journal_records >= CHECKPOINT_EVERY or self._journal.tell() >= CHECKPOINT_BYTES:
+            self.checkpoint()
+
+    def _apply_add(self, user_id, vector_id, embedding):
+        if self._ensure_loaded(user_id) is None:
+            # Размерность задаёт сама модель эмбеддингов
+            self.partitions[user_id] = faiss.IndexFlatIP(len(embedding))
+            self.ids[user_id] = array("q")
+            self.tombstones[user_id] = set()
+        else:
+            self._materialize(user_id)
 
         emb = np.array([embedding]).astype("float32")
-        self.index.add(emb)
-        self.metadata.append(meta)
-        self._save()
-
-    def search(self, query_emb: np.ndarray, top_k=10, threshold=0.3):
-        if self.index is None or self.index.ntotal == 0:
-            return []
-
-        query_emb = np.array([query_emb]).astype("float32")
-        scores, ids = self.index.search(query_emb, top_k)
-        results = []
-        for score, idx in zip(scores[0], ids[0]):
-            if score >= threshold and idx < len(self.metadata):
-                results.append((score, self.metadata[idx]))
-        return results
-
-    def delete(self, condition_fn):
-        new_metadata = []
-        new_embeddings = []
-        for idx, meta in enumerate(self.metadata):
-            if not condition_fn(meta):
-                new_metadata.append(meta)
-                emb = self.index.reconstruct(idx)
-                new_embeddings.append(emb)
-        self._create_index()
-        if new_embeddings:
-            self.index.add(np.array(new_embeddings).astype("float32"))
-        self.metadata = new_metadata
-        self._save()
+        self.partitions[user_id].add(emb)
+        self.ids[user_id].append(vector_id)
+        self._dirty.add(user_id)
+
+    def _needs_rebuild(self, user_id):
+        index = self.partitions[user_id]
+        live = index.ntotal - len(self.tombstones[user_id])
+        kind = index_kind(index)
+        if kind != target_kind(live):
+            return True
+        # IVF, обученный на заметно меньшем объёме, переобучается
+        return kind == "ivf" and ivf_nlist(live) >= 4 * index.nlist
+
+    def _schedule_rebuild(self, user_id):
+        if user_id not in self._compact_pending:
+            self._compact_pending.add(user_id)
+            self._compact_queue.put(user_id)
+
+    def _apply_delete(self, user_id, vector_ids):
+        if self._ensure_loaded(user_id) is None:
+            return False
+
+        tombstones = self.tombstones[user_id]
+        tombstones.update(set(vector_ids).intersection(self.ids[user_id]))
+        self._dirty.add(user_id)
+
+        if len(tombstones) >= len(self.ids[user_id]):
+            # Удалено всё: подындекс просто выбрасывается
+            self._apply_drop(user_id)
+            return False
+        return len(tombstones) > COMPACT_RATIO * len(self.ids[user_id])
+
+    def _apply_drop(self, user_id):
+        for store in (self.partitions, self.ids, self.tombstones):
+            store.pop(user_id, None)
+        self._unloaded.discard(user_id)
+        self._mapped.discard(user_id)
+        self._dirty.add(user_id)
+
+    def add(self, user_id, embedding: np.ndarray):
+        """Добавляет вектор в подындекс пользователя и возвращает его vector_id"""
+        if embedding is None:
+            raise ValueError("Пустой эмбеддинг")
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if embedding.ndim != 1 or embedding.size == 0:
+            raise ValueError(f"Ожидался одномерный эмбеддинг, получена форма {embedding.shape}")
+        with self._lock:
+            # Проверка до записи в журнал: неприменимая запись сломала бы его доигрывание
+            index = self._ensure_loaded(user_id)
+            if index is not None and index.d != embedding.size:
+                raise ValueError(f"Размерность эмбеддинга {embedding.size} не совпадает с индексом ({index.d})")
+            vector_id = self._next_id
+            self._next_id += 1
+            self._append("add", user_id, (vector_id, embedding.tobytes()))
+            self._apply_add(user_id, vector_id, embedding)
+            if INDEX_TYPE != "flat" and self._needs_rebuild(user_id):
+                self._schedule_rebuild(user_id)
+            self._maybe_checkpoint()
+        return vector_id
+
+    def search(self, query_emb: np.ndarray, user_id, top_k=10, threshold=0.3):
+        """Ищет только среди векторов одного пользователя, возвращает [(score, vector_id)]"""
+        with self._lock:
+            index = self._ensure_loaded(user_id)
+            if index is None or index.ntotal == 0:
+                return []
+
+            vector_ids = self.ids[user_id]
+            tombstones = self.tombstones[user_id]
+            query_emb = np.array([query_emb]).astype("float32")
+            scores, positions = index.search(query_emb, min(top_k + len(tombstones), index.ntotal))
+            results = []
+            for score, pos in zip(scores[0], positions[0]):
+                if score < threshold or not 0 <= pos < len(vector_ids):
+                    continue
+                vector_id = int(vector_ids[pos])
+                if vector_id in tombstones:
+                    continue
+                results.append((float(score), vector_id))
+                if len(results) == top_k:
+                    break
+            return results
+
+    def remove_ids(self, user_id, vector_ids):
+        """Помечает векторы удалёнными; сам индекс не перестраивается"""
+        vector_ids = [int(vector_id) for vector_id in vector_ids if vector_id is not None]
+        if not vector_ids:
+            return
+        with self._lock:
+            if self._ensure_loaded(user_id) is None:
+                return
+            self._append("delete", user_id, vector_ids)
+            if self._apply_delete(user_id, vector_ids):
+                self._schedule_rebuild(user_id)
+            self._maybe_checkpoint()
+
+    def drop_partition(self, user_id):
+        """Удаляет все векторы пользователя в коллекции за O(1)"""
+        with self._lock:
+            if user_id not in self.partitions and user_id not in self._unloaded:
+                return
+            self._append("drop", user_id, None)
+            self._apply_drop(user_id)
+            self._maybe_checkpoint()
+
+    def close(self, checkpoint=True):
+        with self._lock:
+            if checkpoint:
+                self.checkpoint()
+            self._journal.close()
+        atexit.unregister(self.checkpoint)
+
+    def _compaction_worker(self):
+        while True:
+            user_id = self._compact_queue.get()
+            try:
+                self._compact(user_id)
+            except Exception as e:
+                print(f"[VectorStore:{self.name}] Ошибка уплотнения подындекса {user_id}: {e}")
+            finally:
+                with self._lock:
+                    self._compact_pending.discard(user_id)
+
+    def _compact(self, user_id):
+        """Пересобирает подындекс без удалённых векторов, не держа блокировку на время сборки.
+
+        Тип нового индекса выбирается по числу живых векторов, так что здесь же
+        происходит переход с плоского индекса на HNSW/IVF и переобучение IVF.
+        """
+        with self._lock:
+            index = self._ensure_loaded(user_id)
+            if index is None:
+                return
+            size = index.ntotal
+            vectors = index.reconstruct_n(0, size)
+            ids = self.ids[user_id][:size]
+            removed = set(self.tombstones[user_id])
+
+        keep = [pos for pos, vector_id in enumerate(ids) if vector_id not in removed]
+        new_index = build_index(target_kind(len(keep)), index.d, vectors[keep])
+
+        with self._lock:
+            if self.partitions.get(user_id) is not index:
+                return
+            # Векторы, добавленные, пока шла сборка, переносим как есть
+            if index.ntotal > size:
+                new_index.add(index.reconstruct_n(size, index.ntotal - size))
+
+            self.partitions[user_id] = new_index
+            self.ids[user_id] = array("q", (int(ids[pos]) for pos in keep)) + array("q", self.ids[user_id][size:])
+            self.tombstones[user_id] -= removed
+            self._mapped.discard(user_id)
+            self._dirty.add(user_id)
+
+
+class VectorStore:
+    """Набор независимых коллекций (свой каталог, журнал и индексы у каждой)"""
+
+    def __init__(self, path=STORE_DIR):
+        self.path = path
+        self.collections = {}
+        self.info_path = os.path.join(path, "info.json")
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        # Остатки коллекций, удаление которых прервал перезапуск
+        for entry in os.listdir(path):
+            if ".dropped-" in entry:
+                self._remove_in_background(os.path.join(path, entry))
+
+    @staticmethod
+    def _remove_in_background(path):
+        threading.Thread(target=shutil.rmtree, args=(path, True), daemon=True).start()
+
+    @staticmethod
+    def remove_legacy_files():
+        """Удаляет файлы старого единого индекса; возвращает удалённые пути"""
+        removed = [path for path in LEGACY_FILES if os.path.exists(path)]
+        for path in removed:
+            os.remove(path)
+        return removed
+
+    def get_model_info(self):
+        """Модель и размерность, которыми построены векторы ({"model", "dim"}), или None"""
+        if not os.path.exists(self.info_path):
+            return None
+        with open(self.info_path) as f:
+            return json.load(f)
+
+    def set_model_info(self, model, dim):
+        tmp_path = self.info_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"model": model, "dim": dim}, f)
+        os.replace(tmp_path, self.info_path)
+
+    def collection_names(self):
+        return [
+            entry for entry in os.listdir(self.path)
+            if os.path.isdir(os.path.join(self.path, entry)) and ".dropped-" not in entry
+        ]
+
+    def collection(self, name):
+        with self._lock:
+            if name not in self.collections:
+                self.collections[name] = Collection(name, os.path.join(self.path, name))
+            return self.collections[name]
+
+    def drop(self, name):
+        """Удаляет коллекцию целиком: каталог переименовывается сразу, а стирается в фоне"""
+        with self._lock:
+            collection = self.collections.pop(name, None)
+            if collection is not None:
+                collection.close(checkpoint=False)
+            path = os.path.join(self.path, name)
+            if not os.path.exists(path):
+                return
+            trash_path = f"{path}.dropped-{time.time_ns()}"
+            os.replace(path, trash_path)
+        self._remove_in_background(trash_path)
+
+
+def recall_report(vectors, queries, k=10, kinds=("hnsw", "ivf"), ef_values=(16, 32, 64, 128), nprobe_values=(4, 8, 16, 32)):
+    """Полнота (recall@k) и задержка ANN-индексов относительно точного Flat на тех же данных"""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    dim = vectors.shape[1]
+
+    def timed_search(index):
+        """Поиск по одному запросу, как в боте; возвращает (найденные позиции, мс на запрос)"""
+        found = []
+        start = time.perf_counter()
+        for query in queries:
+            found.append(index.search(query[None, :], k)[1][0])
+        return found, (time.perf_counter() - start) / len(queries) * 1000
+
+    exact, latency = timed_search(build_index("flat", dim, vectors))
+    rows = [("flat", "-", 1.0, latency)]
+
+    for kind in kinds:
+        start = time.perf_counter()
+        index = build_index(kind, dim, vectors)
+        build_time = time.perf_counter() - start
+        values = ef_values if kind == "hnsw" else nprobe_values
+        for value in values:
+            if kind == "hnsw":
+                tune_index(index, ef_search=value)
+            else:
+                tune_index(index, nprobe=value)
+            found, latency = timed_search(index)
+            recall = np.mean([
+                len(set(a) & set(b)) / k for a, b in zip(exact, found)
+            ])
+            param = f"{'efSearch' if kind == 'hnsw' else 'nprobe'}={value}"
+            rows.append((f"{kind} (сборка {build_time:.1f} с)", param, recall, latency))
+
+    print(f"{len(vectors)} векторов, dim={dim}, {len(queries)} запросов, k={k}")
+    print(f"{'индекс':<28} {'параметр':<14} {'recall@k':>9} {'мс/запрос':>10}")
+    for name, param, recall, latency in rows:
+        print(f"{name:<28} {param:<14} {recall:>9.3f} {latency:>10.3f}")
+    return rows
 
 
 vector_store = VectorStore()
+
+
+if __name__ == "__main__":
+    import sys
+
+    # python vector_store.py [коллекция] — данные коллекции, иначе синтетические кластеры
+    if len(sys.argv) > 1:
+        store = vector_store.collection(sys.argv[1])
+        data = np.concatenate([
+            index.reconstruct_n(0, index.ntotal)
+            for index in map(store._ensure_loaded, store.user_ids())
+        ])
+    else:
+        rng = np.random.default_rng(0)
+        centers = rng.standard_normal((200, 1024)).astype(np.float32)
+        data = centers[rng.integers(0, len(centers), 50000)] + 0.5 * rng.standard_normal((50000, 1024)).astype(np.float32)
+    data /= np.linalg.norm(data, axis=1, keepdims=True)
+    rng = np.random.default_rng(1)
+    sample = data[rng.choice(len(data), min(200, len(data)), replace=False)]
+    recall_report(data, sample + 0.05 * rng.standard_normal(sample.shape).astype(np.float32))